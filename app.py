@@ -1,35 +1,394 @@
 import os
-from flask import Flask, request, abort, jsonify
+import click
+from functools import wraps
+from flask import Flask, Response, request, abort, jsonify, make_response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from database.models import setup_db,  Movie, Actor, setup_migrations
-from auth.auth import AuthError, requires_auth
-from settings import DB_NAME, DB_USER, DB_PASSWORD, DB_HOST
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+from database.models import db, setup_db, setup_async_io, bootstrap_db,  Movie, Actor, setup_migrations, keyset_page, stream_all, \
+    select_rows, update_versioned, select_versioned, delete_by_id, bulk_insert, bulk_update, bulk_delete, bulk_error, attach_related, \
+    add_casting, remove_casting
+from database.bulk_copy import import_rows, export_rows, format_of
+from database.cache import response_cache
+from database.pool import engine_health
+from database.replicas import served_by_replica
+from database.idempotency import idempotency_store, MAX_KEY_LENGTH
+from auth.auth import AuthError, requires_auth, route_permissions
+from metrics import setup_metrics
+from serialization import json_response
+from settings import DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, BULK_MAX_ITEMS, \
+    SERVING_MODE, METRICS_ENABLED, SERVER_TIMING, DATABASE_REPLICA_URLS, READ_YOUR_WRITES_SECONDS, \
+    WEB_CONCURRENCY, RESPONSE_CACHE_URL, RESPONSE_CACHE_TTL
 
 from datetime import datetime
+from dateutil.parser import isoparse
+
+# Tables of the import and export commands
+CATALOGUE = {"movies": Movie, "actors": Actor}
+
+# Largest value of an INTEGER column, larger ids never reach PostgreSQL
+MAX_INTEGER = 2 ** 31 - 1
+
+# True for a JSON integer (not a boolean) that can be the id of a row
+def is_valid_id(value):
+    return isinstance(value, int) and not isinstance(value, bool) and 1 <= value <= MAX_INTEGER
+
+# Converters of the bulk fields, a JSON value of the wrong type raises TypeError
+# (no float or bool for an integer, no number for a string), a malformed value ValueError
+def json_string(value):
+    if not isinstance(value, str):
+        raise TypeError("must be a string")
+    return value
+
+def json_integer(value):
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise TypeError("must be an integer")
+    return value
+
+def json_date(value):
+    return isoparse(json_string(value)).date()
+
+# Column converters used to validate bulk request items
+MOVIE_FIELDS = {"name": json_string, "release_date": json_date}
+ACTOR_FIELDS = {"name": json_string, "age": json_integer, "gender": json_string}
+
+# Validates one bulk item and returns its column values
+# raises ValueError when a field is missing or malformed, TypeError when it has the wrong JSON type
+# partial=True is used for updates: 'id' is required and every other field is optional
+def clean_bulk_item(item, converters, partial=False):
+    if not isinstance(item, dict):
+        raise ValueError("Item must be a JSON object")
+    values = {}
+    if partial:
+        if not is_valid_id(item.get("id")):
+            raise ValueError("id must be an integer between 1 and {}".format(MAX_INTEGER))
+        values["id"] = item["id"]
+    for field, convert in converters.items():
+        value = item.get(field, None)
+        if value is None:
+            if not partial:
+                raise ValueError("{} cannot be empty".format(field))
+            continue
+        try:
+            values[field] = convert(value)
+        except TypeError as e:
+            raise TypeError("{} {}".format(field, e))
+        except ValueError:
+            raise ValueError("Invalid {}".format(field))
+    return values
+
+# Reads the JSON array of a bulk request, aborts 400 if it is not a list or too long
+def get_bulk_items():
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or len(items) > BULK_MAX_ITEMS:
+        print("Bulk request body must be a JSON array of at most", BULK_MAX_ITEMS, "items")
+        abort(400)
+    return items
+
+# Splits bulk items into validated (index, values) rows and per-item errors,
+# 400 for a missing or malformed field, 422 for a field of the wrong JSON type
+def validate_bulk_items(items, converters, partial=False):
+    rows, errors = [], []
+    for index, item in enumerate(items):
+        try:
+            rows.append((index, clean_bulk_item(item, converters, partial)))
+        except ValueError as e:
+            errors.append(bulk_error(index, 400, str(e)))
+        except TypeError as e:
+            errors.append(bulk_error(index, 422, str(e)))
+    return rows, errors
+
+# Reads the JSON array of ids of a bulk DELETE
+# Returns (index, id) rows and per-item 400 errors for booleans, non integers and ids out of range
+def get_bulk_ids():
+    rows, errors = [], []
+    for index, id in enumerate(get_bulk_items()):
+        if is_valid_id(id):
+            rows.append((index, id))
+        else:
+            errors.append(bulk_error(index, 400, "id must be an integer between 1 and {}".format(MAX_INTEGER)))
+    return rows, errors
+
+# Reads ?after_id=&limit=&fields= for the list endpoints
+# Returns None when none is given so the full unpaginated list is served
+def get_page_args(model):
+    args = request.args
+    if not any(name in args for name in ('after_id', 'limit', 'fields')):
+        return None
+    try:
+        after_id = int(args['after_id']) if 'after_id' in args else None
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        print("after_id and limit must be integers")
+        abort(400)
+    if limit < 1:
+        print("limit must be positive")
+        abort(400)
+    if after_id is not None and not -MAX_INTEGER - 1 <= after_id <= MAX_INTEGER:
+        print("after_id must fit an integer column")
+        abort(400)
+
+    # id is always returned, it is the cursor
+    fields = ['id']
+    for field in args.get('fields', ','.join(model.serialized_fields)).split(','):
+        field = field.strip()
+        if not field:
+            continue
+        if field not in model.serialized_fields:
+            print("Unknown field requested", field)
+            abort(400)
+        if field not in fields:
+            fields.append(field)
+
+    return {"fields": fields, "after_id": after_id, "limit": min(limit, MAX_PAGE_SIZE)}
+
+# Escapes LIKE wildcards so user input is matched literally
+def like_escape(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+# ?name= (substring) and ?name_prefix=, both case-insensitive and served by the trigram index on name
+def get_name_filters(model):
+    filters = []
+    if any('\x00' in request.args.get(name, '') for name in ('name', 'name_prefix')):
+        print("name and name_prefix cannot contain NUL characters")
+        abort(400)
+    if request.args.get('name'):
+        filters.append(model.name.ilike('%' + like_escape(request.args['name']) + '%', escape='\\'))
+    if request.args.get('name_prefix'):
+        filters.append(model.name.ilike(like_escape(request.args['name_prefix']) + '%', escape='\\'))
+    return filters
+
+# Filters of GET /movies: name, name_prefix, release_date_from, release_date_to (inclusive)
+def get_movie_filters():
+    filters = get_name_filters(Movie)
+    try:
+        if 'release_date_from' in request.args:
+            filters.append(Movie.release_date >= isoparse(request.args['release_date_from']).date())
+        if 'release_date_to' in request.args:
+            filters.append(Movie.release_date <= isoparse(request.args['release_date_to']).date())
+    except ValueError:
+        print("release_date_from and release_date_to must be ISO dates")
+        abort(400)
+    return filters
+
+# Filters of GET /actors: name, name_prefix, min_age, max_age (inclusive), gender
+def get_actor_filters():
+    filters = get_name_filters(Actor)
+    try:
+        ages = {name: int(request.args[name]) for name in ('min_age', 'max_age') if name in request.args}
+    except ValueError:
+        print("min_age and max_age must be integers")
+        abort(400)
+    if not all(-MAX_INTEGER - 1 <= age <= MAX_INTEGER for age in ages.values()):
+        print("min_age and max_age must fit an integer column")
+        abort(400)
+    if 'min_age' in ages:
+        filters.append(Actor.age >= ages['min_age'])
+    if 'max_age' in ages:
+        filters.append(Actor.age <= ages['max_age'])
+    if '\x00' in request.args.get('gender', ''):
+        print("gender cannot contain NUL characters")
+        abort(400)
+    if request.args.get('gender'):
+        filters.append(Actor.gender == request.args['gender'])
+    return filters
+
+# Reads If-Match of a PATCH, the row versions the client expects
+# Returns None when the header is absent or '*', any version is then updated
+def get_if_match_versions():
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    return [int(tag) for tag in request.if_match.as_set() if tag.isdigit()]
+
+# After a conditional update matched no row: 404 if the row doesn't exist, 412 if its version changed
+def abort_missing_or_changed(model, id):
+    if db.session.execute(db.select(model.id).where(model.id == id)).first() is None:
+        print("No row found for updation with ID: ", id)
+        abort(404)
+    print("Row was changed since If-Match version, ID: ", id)
+    abort(412)
+
+# JSON response carrying the row version in its ETag, sent back in If-Match to update the row
+def versioned_response(body, version):
+    response = jsonify(body)
+    response.set_etag(str(version))
+    return response
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# True when the client prefers NDJSON over JSON in its Accept header
+def wants_ndjson():
+    return request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+# Reads ?include= for the list endpoints, the only accepted value is `relation`
+def get_include(relation):
+    include = request.args.get('include', None)
+    if include is not None and include != relation:
+        print("Unknown relation requested", include)
+        abort(400)
+    return include
+
+# Serves a list endpoint from response_cache, keyed by the collection version and the request URL
+# With ?include= the `related` collection version is part of the key too
+# Answers If-None-Match with 304 without running the view (see ResponseCache.revalidates), only 200 JSON responses are cached
+# Answers read from a replica shortly after a write are neither cached nor tagged, the replica may lag
+def cached_collection(collection, related=None):
+    def cached_collection_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if wants_ndjson():
+                return f(*args, **kwargs)
+
+            collections = (collection, related) if related and 'include' in request.args else collection
+            etag = response_cache.etag(collections, request.full_path)
+            if request.if_none_match.contains(etag) and response_cache.revalidates(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            body = response_cache.get(etag)
+            if body is None:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                # A replica may not have replayed a recent write yet, its answer gets no ETag until then
+                if served_by_replica() and response_cache.changed_within(collections, READ_YOUR_WRITES_SECONDS):
+                    return response
+                response_cache.set(etag, response.get_data())
+            else:
+                response = Response(body, mimetype='application/json')
+            response.set_etag(etag)
+            return response
+
+        return wrapper
+    return cached_collection_decorator
+
+# Replays the response of a POST to retries sent with the same Idempotency-Key header, see IdempotencyStore
+# Only 2xx responses are kept, after an error the key is released and a retry runs again
+# A key reused with another body gets 422, one still held by a running request after the wait gets 409
+def idempotent(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is None:
+            return f(*args, **kwargs)
+        if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+            print("Idempotency-Key must have 1 to", MAX_KEY_LENGTH, "characters")
+            abort(400)
+
+        key = idempotency_store.key(idempotency_key)
+        fingerprint = idempotency_store.fingerprint()
+        entry = idempotency_store.claim(key, fingerprint)
+        if entry is None:
+            try:
+                response = make_response(f(*args, **kwargs))
+            except BaseException:
+                idempotency_store.release(key)
+                raise
+            if 200 <= response.status_code < 300:
+                idempotency_store.complete(key, fingerprint, response)
+            else:
+                idempotency_store.release(key)
+            return response
+
+        if entry["fingerprint"] != fingerprint:
+            print("Idempotency-Key reused with a different request body")
+            abort(422)
+        if entry["status"] is None:
+            print("Request with the same Idempotency-Key still in progress")
+            abort(409)
+        response = Response(entry["body"], status=entry["status"], mimetype='application/json')
+        if entry["etag"]:
+            response.headers["ETag"] = entry["etag"]
+        response.headers["Idempotent-Replayed"] = "true"
+        return response
 
-def create_app():
+    return wrapper
+
+# database_path and replica_paths default to DATABASE_URL (or the local database) and DATABASE_REPLICA_URLS
+def create_app(database_path=None, replica_paths=None):
 
     app = Flask(__name__)
     # Get Database URL from the environment variable
     DATABASE_URI = os.environ.get("DATABASE_URL")
 
-    # Setting up Database URI in correct format
-    if DATABASE_URI is None:
+    # Setting up Database URI in correct format, an explicit path (e.g. from the tests) wins
+    if database_path is not None:
+        DATABASE_URI = database_path
+    elif DATABASE_URI is None:
         DATABASE_URI = "postgresql://{}:{}@{}/{}".format(DB_USER, DB_PASSWORD, DB_HOST, DB_NAME)
         print("Local configured Database URI is ", DATABASE_URI)
     else:
         DATABASE_URI = DATABASE_URI.replace("://", "ql://", 1)
         print("Prod configured Database URI is ", DATABASE_URI)
 
-    setup_db(app, DATABASE_URI)
+    # In async mode the same routes run in gevent greenlets, DB waits must yield too
+    app.config["SERVING_MODE"] = SERVING_MODE
+    if SERVING_MODE == "async":
+        setup_async_io()
+
+    # Optional read replicas, postgres:// URLs are fixed by setup_db
+    setup_db(app, DATABASE_URI, DATABASE_REPLICA_URLS if replica_paths is None else replica_paths)
     setup_migrations(app)
     CORS(app)
 
+    # Each worker then only sees its own writes, the others serve their cached lists until they expire,
+    # and a retry with an Idempotency-Key served by another worker inserts again
+    if WEB_CONCURRENCY > 1 and not RESPONSE_CACHE_URL:
+        print("WARNING: {} workers without RESPONSE_CACHE_URL, cached lists may be stale for up to {} s "
+              "after a write and Idempotency-Key retries are only deduplicated per worker".format(
+                  WEB_CONCURRENCY, RESPONSE_CACHE_TTL))
+
+    # Request and per-phase timing histograms on GET /metrics
+    if METRICS_ENABLED:
+        setup_metrics(app, server_timing=SERVER_TIMING)
+
+    # Database provisioning, kept out of the startup path
+    @app.cli.command("bootstrap-db")
+    def bootstrap_db_command():
+        """Create the database and its tables if they don't exist."""
+        bootstrap_db(app.config["SQLALCHEMY_DATABASE_URI"])
+
+    # Bulk load and dump of the catalogue through PostgreSQL COPY, e.g. `flask --app app import movies movies.csv`
+    @app.cli.command("import")
+    @click.argument("table", type=click.Choice(sorted(CATALOGUE)))
+    @click.argument("path")
+    @click.option("--format", "format_name", type=click.Choice(["csv", "ndjson"]), help="Defaults to the file extension.")
+    def import_command(table, path, format_name):
+        """Load a CSV (with a header line) or NDJSON file into a table, - reads stdin."""
+        try:
+            import_rows(db, CATALOGUE[table], path, format_name or format_of(path))
+        except Exception as e:
+            raise click.ClickException("Import failed, nothing was loaded: {}".format(e))
+
+    @app.cli.command("export")
+    @click.argument("table", type=click.Choice(sorted(CATALOGUE)))
+    @click.argument("path")
+    @click.option("--format", "format_name", type=click.Choice(["csv", "ndjson"]), help="Defaults to the file extension.")
+    def export_command(table, path, format_name):
+        """Write every row of a table to a CSV or NDJSON file, - writes to stdout."""
+        export_rows(db, CATALOGUE[table], path, format_name or format_of(path))
+
+    # Permissions required by each route, for auditing the RBAC setup
+    @app.cli.command("permissions")
+    def permissions_command():
+        """List the routes and the permissions they require."""
+        for rule, methods, endpoint, required in route_permissions(app):
+            print("{:<36} {:<20} {}".format(rule, ",".join(methods), required.describe() if required else "public"))
+
+    # Streams one JSON line per row, encoded like jsonify so lines match the list endpoints
+    def ndjson_response(model, serialize):
+        def generate():
+            for record in stream_all(model):
+                yield app.json.dumps(serialize(record)) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
     # CORS Headers
     @app.after_request
     def after_request(response):
-        response.headers.add("Access-Control-Allow-Headers", "Content-Type,Authorization,true")
+        response.headers.add("Access-Control-Allow-Headers", "Content-Type,Authorization,Idempotency-Key,true")
         response.headers.add("Access-Control-Allow-Methods", "GET,PUT,POST,DELETE,OPTIONS")
         return response
 
@@ -39,28 +398,64 @@ def create_app():
         return jsonify({"success": True, 
                         "message": "Hello! This is  our Home URL page"})
 
+    # Database health and connection pool usage, used to size the pool
+    # The primary and each read replica are probed on their own engine, next to their own pool
+    @app.route('/health/db')
+    def database_health():
+        healthy, status = engine_health(db.engine)
+        replicas = {}
+        for key, engine in db.engines.items():
+            if key is not None:
+                replica_healthy, replica_status = engine_health(engine)
+                replicas[key] = {"success": replica_healthy, "pool": replica_status}
+                healthy = healthy and replica_healthy
+        return jsonify({"success": healthy, "pool": status, "replicas": replicas}), 200 if healthy else 503
+
     @app.route('/movies', methods=['GET'])
     @requires_auth('view:movies')
+    @cached_collection('movies', related='actors')
     def get_all_movies(payload):
-        try:
-            movies_query = Movie.query.order_by(Movie.id).all()
-            movies = [movie.serialized_movie() for movie in movies_query]
-
+        if wants_ndjson():
+            return ndjson_response(Movie, Movie.serialized_movie)
+
+        include = get_include('actors')
+        filters = get_movie_filters()
+        page_args = get_page_args(Movie)
+        if page_args is not None:
+            movies, next_cursor = keyset_page(Movie, filters=filters, **page_args)
+            if include:
+                attach_related(movies, Movie, include)
+            return json_response({
+                "success": True,
+                "movies": movies,
+                "next_cursor": next_cursor
+            })
 
+        try:
+            movies = select_rows(Movie, Movie.serialized_fields, filters)
         except Exception as e:
             print("Error while getting all Movies", e)
-        
-        if len(movies) == 0:
+            abort(422)
+
+        if len(movies) == 0 and not filters:
             print("Movies Database is empty")
             abort(404)
+        if include:
+            attach_related(movies, Movie, include)
 
-        return jsonify({
+        return json_response({
             "success": True,
             "movies": movies
         })
 
+    @app.route('/movies/export', methods=['GET'])
+    @requires_auth('view:movies')
+    def export_movies(payload):
+        return ndjson_response(Movie, Movie.serialized_movie)
+
     @app.route('/movie', methods=['POST'])
     @requires_auth('post:movie')
+    @idempotent
     def create_movie(payload):
         req_body = request.get_json()
         name = req_body.get("name", None)
@@ -76,72 +471,189 @@ def create_app():
             except Exception as e:
                 print("Error occured while during INSERT", e)
                 abort(422)
-        return jsonify({'success': True, 'movie': movie_data.serialized_movie()})
+        return versioned_response({'success': True, 'movie': movie_data.serialized_movie()}, movie_data.version)
+
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movie')
+    @idempotent
+    def create_movies_bulk(payload):
+        rows, errors = validate_bulk_items(get_bulk_items(), MOVIE_FIELDS)
+        movies, insert_errors = bulk_insert(Movie, rows)
+        return jsonify({'success': True, 'movies': movies,
+                        'errors': sorted(errors + insert_errors, key=lambda error: error['index'])})
+
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth('update:movie')
+    def update_movies_bulk(payload):
+        rows, errors = validate_bulk_items(get_bulk_items(), MOVIE_FIELDS, partial=True)
+        updated, update_errors = bulk_update(Movie, rows)
+        return jsonify({'success': True, 'updated': updated,
+                        'errors': sorted(errors + update_errors, key=lambda error: error['index'])})
+
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @requires_auth('delete:movie')
+    def delete_movies_bulk(payload):
+        rows, errors = get_bulk_ids()
+        deleted, delete_errors = bulk_delete(Movie, rows)
+        return jsonify({'success': True, 'deleted': deleted,
+                        'errors': sorted(errors + delete_errors, key=lambda error: error['index'])})
 
     @app.route('/movie/<int:movie_id>', methods=['DELETE'])
     @requires_auth('delete:movie')
     def delete_movie(payload, movie_id):
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-
-        if movie is None:
-            print("No movie found to be deleted", movie)
-            abort(404)
         try:
-            # Delete the selected Movie record 
-            movie.delete()
+            # One DELETE ... RETURNING id, no prior SELECT
+            deleted = delete_by_id(Movie, movie_id)
         except Exception as e:
+            db.session.rollback()
             print("Error occured while Deleting the movie", e)
             abort(422)
 
+        if not deleted:
+            print("No movie found to be deleted", movie_id)
+            abort(404)
+
         return jsonify({'success': True, 'id': movie_id})
 
 
     @app.route('/movie/<int:movie_id>', methods=['PATCH'])
     @requires_auth('update:movie')
     def update_movie(payload, movie_id):
-        movie_tbu = Movie.query.filter(Movie.id == movie_id).one_or_none()
-
-        if movie_tbu is None:
-            print("No movie found for updation with movie id: ", movie_id)
-            abort(404)
+        versions = get_if_match_versions()
         try:
             movie_data = request.get_json()
-            name = movie_data.get("name", None)
-            release_date = movie_data.get("release_date", None)
-
-            if name is not None:
-                movie_tbu.name = name
-            if release_date is not None:
-                movie_tbu.release_date = release_date
-            
-            movie_tbu.update()
-        
+            values = {}
+            if movie_data.get("name", None) is not None:
+                values["name"] = movie_data["name"]
+            if movie_data.get("release_date", None) is not None:
+                values["release_date"] = movie_data["release_date"]
+
+            # One UPDATE ... RETURNING, conditional on the If-Match version
+            # Without any known field the row is returned as it is, its version isn't bumped
+            if values:
+                movie, version = update_versioned(Movie, movie_id, values, versions)
+            else:
+                movie, version = select_versioned(Movie, movie_id, versions)
+
         except Exception as e:
+            db.session.rollback()
             print("Error occured while during UPDATE", e)
             abort(422)
-        return jsonify({"success": True,
-                        "movie": movie_tbu.serialized_movie()})
+        if movie is None:
+            abort_missing_or_changed(Movie, movie_id)
+        return versioned_response({"success": True,
+                                   "movie": movie}, version)
+
+    @app.route('/movie/<int:movie_id>/actors', methods=['GET'])
+    @requires_auth('view:actors')
+    def get_movie_actors(payload, movie_id):
+        movie = db.session.execute(
+            db.select(Movie).options(selectinload(Movie.actors)).where(Movie.id == movie_id)
+        ).scalar_one_or_none()
+
+        if movie is None:
+            print("No movie found with movie id: ", movie_id)
+            abort(404)
+
+        # No ETag: casting changes this body without bumping the movie's version
+        return jsonify({"success": True, "movie": movie.serialized_movie(),
+                        "actors": [actor.serialized_actor() for actor in movie.actors]})
+
+    @app.route('/actor/<int:actor_id>/movies', methods=['GET'])
+    @requires_auth('view:movies')
+    def get_actor_movies(payload, actor_id):
+        actor = db.session.execute(
+            db.select(Actor).options(selectinload(Actor.movies)).where(Actor.id == actor_id)
+        ).scalar_one_or_none()
+
+        if actor is None:
+            print("No actor found with Actor ID: ", actor_id)
+            abort(404)
+
+        # No ETag: casting changes this body without bumping the actor's version
+        return jsonify({"success": True, "actor": actor.serialized_actor(),
+                        "movies": [movie.serialized_movie() for movie in actor.movies]})
+
+    @app.route('/movie/<int:movie_id>/actors', methods=['POST'])
+    @requires_auth('update:movie')
+    def cast_actor(payload, movie_id):
+        req_body = request.get_json(silent=True) or {}
+        actor_id = req_body.get("actor_id", None)
+        if not isinstance(actor_id, int) or isinstance(actor_id, bool):
+            print("actor_id must be an integer")
+            abort(400)
+
+        try:
+            add_casting(movie_id, actor_id)
+        except IntegrityError:
+            db.session.rollback()
+            print("No movie or actor found for casting", movie_id, actor_id)
+            abort(404)
+        except Exception as e:
+            db.session.rollback()
+            print("Error occured while during casting", e)
+            abort(422)
+        return jsonify({"success": True, "movie_id": movie_id, "actor_id": actor_id})
+
+    @app.route('/movie/<int:movie_id>/actors/<int:actor_id>', methods=['DELETE'])
+    @requires_auth('update:movie')
+    def uncast_actor(payload, movie_id, actor_id):
+        try:
+            removed = remove_casting(movie_id, actor_id)
+        except Exception as e:
+            db.session.rollback()
+            print("Error occured while removing the casting", e)
+            abort(422)
+        if not removed:
+            print("Actor is not cast in the movie", movie_id, actor_id)
+            abort(404)
+        return jsonify({"success": True, "movie_id": movie_id, "actor_id": actor_id})
 
     @app.route('/actors', methods=['GET'])
     @requires_auth('view:actors')
+    @cached_collection('actors', related='movies')
     def get_all_actors(payload):
+        if wants_ndjson():
+            return ndjson_response(Actor, Actor.serialized_actor)
+
+        include = get_include('movies')
+        filters = get_actor_filters()
+        page_args = get_page_args(Actor)
+        if page_args is not None:
+            actors, next_cursor = keyset_page(Actor, filters=filters, **page_args)
+            if include:
+                attach_related(actors, Actor, include)
+            return json_response({
+                "success": True,
+                "actors": actors,
+                "next_cursor": next_cursor
+            })
+
         try:
-            actors_query = Actor.query.order_by(Actor.id).all()
-            actors = [actor.serialized_actor() for actor in actors_query]
+            actors = select_rows(Actor, Actor.serialized_fields, filters)
         except Exception as e:
             print("Error while getting all Actors", e)
-        
-        if len(actors) == 0:
+            abort(422)
+
+        if len(actors) == 0 and not filters:
             print("Actors Database is empty")
             abort(404)
+        if include:
+            attach_related(actors, Actor, include)
 
-        return jsonify({
+        return json_response({
             "success": True,
             "actors": actors
         })
 
+    @app.route('/actors/export', methods=['GET'])
+    @requires_auth('view:actors')
+    def export_actors(payload):
+        return ndjson_response(Actor, Actor.serialized_actor)
+
     @app.route('/actor', methods=['POST'])
     @requires_auth('post:actor')
+    @idempotent
     def create_actor(payload):
         req_body = request.get_json()
         name = req_body.get("name", None)
@@ -158,54 +670,77 @@ def create_app():
             except Exception as e:
                 print("Error occured while during INSERT", e)
                 abort(422)
-        return jsonify({'success': True, 'actor': actor_data.serialized_actor()})
+        return versioned_response({'success': True, 'actor': actor_data.serialized_actor()}, actor_data.version)
+
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actor')
+    @idempotent
+    def create_actors_bulk(payload):
+        rows, errors = validate_bulk_items(get_bulk_items(), ACTOR_FIELDS)
+        actors, insert_errors = bulk_insert(Actor, rows)
+        return jsonify({'success': True, 'actors': actors,
+                        'errors': sorted(errors + insert_errors, key=lambda error: error['index'])})
+
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth('update:actor')
+    def update_actors_bulk(payload):
+        rows, errors = validate_bulk_items(get_bulk_items(), ACTOR_FIELDS, partial=True)
+        updated, update_errors = bulk_update(Actor, rows)
+        return jsonify({'success': True, 'updated': updated,
+                        'errors': sorted(errors + update_errors, key=lambda error: error['index'])})
+
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @requires_auth('delete:actor')
+    def delete_actors_bulk(payload):
+        rows, errors = get_bulk_ids()
+        deleted, delete_errors = bulk_delete(Actor, rows)
+        return jsonify({'success': True, 'deleted': deleted,
+                        'errors': sorted(errors + delete_errors, key=lambda error: error['index'])})
 
     @app.route('/actor/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actor')
     def delete_actor(payload, actor_id):
-        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-
-        if actor is None:
-            print("No actor found to be deleted", actor)
-            abort(404)
         try:
-            # Delete the selected Actor record 
-            actor.delete()
+            # One DELETE ... RETURNING id, no prior SELECT
+            deleted = delete_by_id(Actor, actor_id)
         except Exception as e:
+            db.session.rollback()
             print("Error occured while Deleting the actor", e)
             abort(422)
 
+        if not deleted:
+            print("No actor found to be deleted", actor_id)
+            abort(404)
+
         return jsonify({'success': True, 'id': actor_id})
 
 
     @app.route('/actor/<int:actor_id>', methods=['PATCH'])
     @requires_auth('update:actor')
     def update_actor(payload, actor_id):
-        actor_tbu = Actor.query.filter(Actor.id == actor_id).one_or_none()
-
-        if actor_tbu is None:
-            print("No actor found for updation with Actor ID: ", actor_id)
-            abort(404)
+        versions = get_if_match_versions()
         try:
             actor_data = request.get_json()
-            name = actor_data.get("name", None)
-            age = actor_data.get("age", None)
-            gender = actor_data.get("gender", None)
-
-            if name is not None:
-                actor_tbu.name = name
-            if age is not None:
-                actor_tbu.age = age
-            if gender is not None:
-                actor_tbu.gender = gender
-
-            actor_tbu.update()
-        
+            values = {}
+            for field in ("name", "age", "gender"):
+                if actor_data.get(field, None) is not None:
+                    values[field] = actor_data[field]
+
+            # One UPDATE ... RETURNING, conditional on the If-Match version
+            # Without any known field the row is returned as it is, its version isn't bumped
+            if values:
+                actor, version = update_versioned(Actor, actor_id, values, versions)
+            else:
+                actor, version = select_versioned(Actor, actor_id, versions)
+
         except Exception as e:
+            db.session.rollback()
             print("Error occured while during UPDATE", e)
             abort(422)
-        return jsonify({"success": True,
-                        "actor": actor_tbu.serialized_actor()})
+        if actor is None:
+            abort_missing_or_changed(Actor, actor_id)
+        return versioned_response({"success": True,
+                                   "actor": actor}, version)
 
     @app.errorhandler(400)
     def bad_request(error):
@@ -247,6 +782,22 @@ def create_app():
             "message": "Method not allowed"
         }), 405
 
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": "Conflict, a request with the same Idempotency-Key is in progress"
+        }), 409
+
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            "success": False,
+            "error": 412,
+            "message": "Precondition failed, the resource was changed"
+        }), 412
+
     @app.errorhandler(422)
     def not_processable(error):
         return jsonify({
@@ -1,14 +1,46 @@
+import hashlib
 import json
 import os
-from flask import request, _request_ctx_stack, abort
+import threading
+import time
+from flask import request, g
+from collections import OrderedDict
 from functools import wraps
-from jose import jwt
+from jose import jwk, jwt
 from urllib.request import urlopen
+from metrics import timed_phase
+
+# Signing algorithms the API is willing to verify
+SUPPORTED_ALGORITHMS = ('RS256', 'RS384', 'RS512')
+
+'''
+parse_algorithms(value)
+Turns the ALGORITHMS env value into a whitelist of supported algorithms
+    accepts "RS256", "RS256,RS384" and the "['RS256']" form used in .env
+    unknown names are dropped, RS256 is the default
+'''
+def parse_algorithms(value):
+    names = [name.strip(" '\"") for name in (value or 'RS256').strip(' []').split(',')]
+    allowed = [name for name in names if name in SUPPORTED_ALGORITHMS]
+    if not allowed:
+        raise ValueError("No supported algorithm in ALGORITHMS: {}".format(value))
+    return allowed
 
 # Declare OS Environment parameters
 AUTH0_DOMAIN = os.environ.get("AUTH0_DOMAIN")
-ALGORITHMS = os.environ.get("ALGORITHMS")
+ALGORITHMS = parse_algorithms(os.environ.get("ALGORITHMS"))
 API_AUDIENCE = os.environ.get("API_AUDIENCE")
+AUTH0_ISSUER = 'https://' + str(AUTH0_DOMAIN) + '/'
+
+# JWKS source, either an URL (https://, http:// stub server, file://) or a local file path
+# use_key_source() replaces it in process, e.g. with a LocalTokenIssuer in tests
+JWKS_URL = os.environ.get("JWKS_URL", f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+# Seconds a fetched key set stays valid
+JWKS_CACHE_TTL = int(os.environ.get("JWKS_CACHE_TTL", 3600))
+# Minimum seconds between two fetches triggered by an unknown kid
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get("JWKS_MIN_REFRESH_INTERVAL", 60))
+# Maximum number of verified tokens kept in memory, 0 disables the cache
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 1024))
 
 ## AuthError Exception
 '''
@@ -20,6 +52,198 @@ class AuthError(Exception):
         self.error = error
         self.status_code = status_code
 
+## JWKS Cache
+'''
+JWKSCache
+Keeps the JSON Web Key Set in memory, indexed by kid
+    the key set comes from `source`: a URL, a local file path or a callable returning the JWKS dict
+    each JWK is turned into ready-to-use public key objects, one per allowed algorithm
+    the key set is fetched lazily on first use and kept for `ttl` seconds
+    a background timer refreshes it before it expires
+    an unknown kid triggers at most one refetch per `min_refresh_interval`
+    a failed refresh keeps serving the previously fetched keys
+'''
+class JWKSCache:
+    def __init__(self, source, ttl=JWKS_CACHE_TTL, min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 background_refresh=True):
+        self.source = source
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.background_refresh = background_refresh
+        self.fetch_count = 0
+        self._keys = {}
+        self._expires_at = 0
+        self._last_fetch = 0
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def fetch(self):
+        if callable(self.source):
+            return self.source()
+        # Plain paths are read from disk, everything else goes through urlopen
+        if '://' not in self.source:
+            with open(self.source) as jwks_file:
+                return json.load(jwks_file)
+        with urlopen(self.source) as jsonurl:
+            return json.loads(jsonurl.read())
+
+    def refresh(self):
+        with self._lock:
+            return self._load()
+
+    def _load(self):
+        # Caller must hold self._lock
+        self._last_fetch = time.monotonic()
+        self.fetch_count += 1
+        try:
+            jwks = self.fetch()
+        except Exception as e:
+            print("Error while fetching JWKS from", self.source, e)
+            self._schedule(self.min_refresh_interval)
+            return False
+
+        self._keys = self.build_keys(jwks)
+        self._expires_at = self._last_fetch + self.ttl
+        # Refresh ahead of expiry so requests never wait on the fetch
+        self._schedule(self.ttl * 0.8)
+        return True
+
+    @staticmethod
+    def build_keys(jwks):
+        # Key objects are built once here so verify_decode_jwt only does the signature math
+        keys = {}
+        for key in jwks.get('keys', []):
+            if 'kid' not in key or key.get('kty') != 'RSA' or key.get('use', 'sig') != 'sig':
+                continue
+            algorithms = [key['alg']] if 'alg' in key else ALGORITHMS
+            verifiers = {}
+            for algorithm in algorithms:
+                if algorithm not in ALGORITHMS:
+                    continue
+                try:
+                    verifiers[algorithm] = jwk.construct(key, algorithm)
+                except Exception as e:
+                    print("Skipping unusable JWKS key", key['kid'], e)
+            if verifiers:
+                keys[key['kid']] = verifiers
+        return keys
+
+    def _needs_refresh(self, kid):
+        now = time.monotonic()
+        if now >= self._expires_at and now - self._last_fetch >= min(self.min_refresh_interval, self.ttl):
+            return True
+        # Keys may have been rotated since the last fetch
+        return kid not in self._keys and now - self._last_fetch >= self.min_refresh_interval
+
+    def _schedule(self, delay):
+        if not self.background_refresh:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(max(delay, 1), self.refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def get_key(self, kid):
+        if self._needs_refresh(kid):
+            with self._lock:
+                # Another thread may have refreshed while we waited for the lock
+                if self._needs_refresh(kid):
+                    self._load()
+        return self._keys.get(kid)
+
+    def clear(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._keys = {}
+            self._expires_at = 0
+            self._last_fetch = 0
+
+
+jwks_cache = JWKSCache(JWKS_URL)
+
+## Verified Token Cache
+'''
+VerifiedTokenCache
+Bounded LRU of tokens that already passed signature and claims checks
+    entries are keyed by the sha256 of the token, the raw token is never stored
+    each entry keeps the payload and its permissions claim turned into a frozenset
+    each entry expires at the token's exp claim
+    hits and misses are counted for monitoring
+'''
+class VerifiedTokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        verified = self.get_verified(token)
+        return verified[0] if verified is not None else None
+
+    # Returns (payload, permissions) of a cached token, None when it isn't cached
+    def get_verified(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, payload, permissions = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload, permissions
+
+    def set(self, token, payload, permissions=None):
+        # Tokens without exp are never cached, they would live forever
+        if self.maxsize <= 0 or 'exp' not in payload:
+            return
+        if permissions is None:
+            permissions = token_permissions(payload)
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (payload['exp'], payload, permissions)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'size': len(self._entries), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses}
+
+
+token_cache = VerifiedTokenCache()
+
+'''
+use_key_source(source)
+Verifies tokens with the keys of another source from now on
+    source is a JWKS URL, a file path or a callable returning the JWKS dict,
+    e.g. LocalTokenIssuer.jwks so tests and load tests run without Auth0
+    keys and verified tokens of the previous source are dropped
+'''
+def use_key_source(source):
+    jwks_cache.clear()
+    jwks_cache.source = source
+    token_cache.clear()
+
 ## Auth Header
 '''
 @TODO implement get_token_auth_header() method
@@ -59,22 +283,60 @@ def get_token_auth_header():
     token = parts[1]
     return token
 
+## Permissions
+'''
+RequiredPermissions
+The permissions a route requires, compiled once when the route is decorated
+    every permission of all_of must be granted, and one of any_of when any_of is given
+    an empty RequiredPermissions only requires a valid token
+'''
+class RequiredPermissions:
+    def __init__(self, all_of=(), any_of=()):
+        self.all_of = frozenset(all_of)
+        self.any_of = frozenset(any_of)
+
+    def allows(self, permissions):
+        return self.all_of <= permissions and (not self.any_of or not self.any_of.isdisjoint(permissions))
+
+    def describe(self):
+        rules = []
+        if self.all_of:
+            rules.append(' and '.join(sorted(self.all_of)))
+        if self.any_of:
+            rules.append('any of ' + ', '.join(sorted(self.any_of)))
+        return '; '.join(rules) or 'authenticated'
+
+    def __repr__(self):
+        return 'RequiredPermissions({!r})'.format(self.describe())
+
+# The permissions claim of a token as a frozenset, None when the claim is missing or not a list
+def token_permissions(payload):
+    permissions = payload.get('permissions')
+    if not isinstance(permissions, list):
+        return None
+    return frozenset(permission for permission in permissions if isinstance(permission, str))
+
 '''
 @TODO implement check_permissions(permission, payload) method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
-        payload: decoded jwt payload
+        required: RequiredPermissions of the route, or a permission string (i.e. 'post:drink')
+        permissions: frozenset of the token's permissions (token_permissions), None without the claim
 
     it should raise an AuthError if permissions are not included in the payload
         !!NOTE check your RBAC settings in Auth0
-    it should raise an AuthError if the requested permission string is not in the payload permissions array
+    it should raise an AuthError if the required permissions are not granted
     return true otherwise
 '''
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        abort(403)
+def check_permissions(required, permissions):
+    if permissions is None:
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Permissions not included in JWT.'
+        }, 403)
 
-    if permission not in payload['permissions']:
+    if isinstance(required, str):
+        required = RequiredPermissions([required] if required else [])
+    if not required.allows(permissions):
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission Not found',
@@ -87,45 +349,54 @@ def check_permissions(permission, payload):
         token: a json web token (string)
 
     it should be an Auth0 token with key id (kid)
-    it should verify the token using Auth0 /.well-known/jwks.json
+    it should verify the token using Auth0 /.well-known/jwks.json (served from jwks_cache)
     it should decode the payload from the token
     it should validate the claims
+    it should return the cached payload for tokens already verified (token_cache)
     return the decoded payload
 
     !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 '''
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    return verify_token(token)[0]
+
+# verify_decode_jwt returning (payload, permissions), permissions as given by token_permissions
+def verify_token(token):
+    # Tokens seen before skip header parsing, signature checks and permission parsing
+    verified = token_cache.get_verified(token)
+    if verified is not None:
+        return verified
+
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    if rsa_key:
+    algorithm = unverified_header.get('alg')
+    if algorithm not in ALGORITHMS:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Token signing algorithm is not allowed.'
+        }, 401)
+
+    verifiers = jwks_cache.get_key(unverified_header['kid'])
+    public_key = verifiers.get(algorithm) if verifiers else None
+    if public_key is not None:
         try:
             payload = jwt.decode(
                 token,
-                rsa_key,
-                algorithms=ALGORITHMS,
+                public_key,
+                algorithms=[algorithm],
                 audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                issuer=AUTH0_ISSUER
             )
+            permissions = token_permissions(payload)
+            token_cache.set(token, payload, permissions)
 
-            return payload
+            return payload, permissions
 
         except jwt.ExpiredSignatureError:
             raise AuthError({
@@ -151,21 +422,44 @@ def verify_decode_jwt(token):
 '''
 @TODO implement @requires_auth(permission) decorator method
     @INPUTS
-        permission: string permission (i.e. 'post:movie')
+        permissions: string permissions (i.e. 'post:movie'), all of them are required
+        any_of: string permissions, at least one of them is required
 
+    the required permissions are compiled once here, into a RequiredPermissions
+    kept on the route function as required_permissions (see route_permissions)
     it should use the get_token_auth_header method to get the token
-    it should use the verify_decode_jwt method to decode the jwt
+    it should use the verify_token method to decode the jwt and get its permissions
     it should use the check_permissions method validate claims and check the requested permission
     return the decorator which passes the decoded payload to the decorated method
 '''
-def requires_auth(permission=''):
+def requires_auth(*permissions, any_of=()):
+    required = RequiredPermissions([permission for permission in permissions if permission], any_of)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with timed_phase('auth'):
+                token = get_token_auth_header()
+                payload, granted = verify_token(token)
+                check_permissions(required, granted)
+            # Who made the request, e.g. for the audit log
+            g.jwt_payload = payload
             return f(payload, *args, **kwargs)
 
+        wrapper.required_permissions = required
         return wrapper
-    return requires_auth_decorator
\ No newline at end of file
+    return requires_auth_decorator
+
+'''
+route_permissions(app)
+Registry of the permissions required by each route of the app, for auditing
+    returns (rule, methods, endpoint, RequiredPermissions) sorted by rule,
+    RequiredPermissions is None for public routes
+'''
+def route_permissions(app):
+    routes = []
+    for rule in app.url_map.iter_rules():
+        view = app.view_functions.get(rule.endpoint)
+        methods = sorted(rule.methods - {'HEAD', 'OPTIONS'})
+        routes.append((rule.rule, methods, rule.endpoint, getattr(view, 'required_permissions', None)))
+    return sorted(routes, key=lambda route: (route[0], route[1]))
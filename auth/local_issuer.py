@@ -0,0 +1,57 @@
+import json
+import time
+from jose import jwk, jwt
+from rsa import newkeys
+
+# Permissions of the three Auth0 roles, see Roles and Permissions in the README
+ROLE_PERMISSIONS = {
+    'casting_assistant': ['view:actors', 'view:movies'],
+    'casting_director': ['view:actors', 'view:movies', 'post:actor', 'delete:actor', 'update:actor', 'update:movie'],
+    'executive_producer': ['view:actors', 'view:movies', 'post:actor', 'delete:actor', 'update:actor', 'update:movie',
+                           'post:movie', 'delete:movie'],
+}
+
+'''
+LocalTokenIssuer
+Offline stand-in for Auth0, for benchmarks and tests
+    generates a throw-away RSA key pair
+    mints RS256 tokens with the same claims Auth0 puts in ours (iss, aud, sub, exp, permissions)
+    exposes the matching JWKS, either in process with auth.use_key_source(issuer.jwks)
+    or from a file or a stub server through JWKS_URL
+'''
+class LocalTokenIssuer:
+    def __init__(self, domain, audience, kid='local-issuer-key', key_size=2048):
+        self.issuer = 'https://{}/'.format(domain)
+        self.audience = audience
+        self.kid = kid
+        _, private_key = newkeys(key_size)
+        self._private_pem = private_key.save_pkcs1().decode()
+        public_jwk = jwk.construct(self._private_pem, 'RS256').public_key().to_dict()
+        public_jwk.update({'kid': kid, 'use': 'sig'})
+        self._public_jwk = public_jwk
+
+    def jwks(self):
+        return {'keys': [dict(self._public_jwk)]}
+
+    def write_jwks(self, path):
+        with open(path, 'w') as jwks_file:
+            json.dump(self.jwks(), jwks_file)
+        return path
+
+    def mint(self, permissions, subject='local|tester', expires_in=3600):
+        now = int(time.time())
+        claims = {
+            'iss': self.issuer,
+            'sub': subject,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }
+        # Without an audience configured the API checks none, the token must not carry one
+        if self.audience is not None:
+            claims['aud'] = self.audience
+        return jwt.encode(claims, self._private_pem, algorithm='RS256', headers={'kid': self.kid})
+
+    # Token of one of the ROLE_PERMISSIONS roles, like Auth0 issues to a user with that role
+    def mint_role(self, role, expires_in=3600):
+        return self.mint(ROLE_PERMISSIONS[role], subject='local|' + role, expires_in=expires_in)
@@ -0,0 +1,72 @@
+'''
+Microbenchmark for the JWT decode path
+Compares building the RSA key from the raw JWK fields on every request
+(the old verify_decode_jwt behaviour) with the public key objects that
+JWKSCache builds once when the key set loads.
+
+Runs offline, a throw-away RSA key pair signs the token.
+    python benchmarks/bench_auth_keys.py [iterations]
+'''
+import os
+import sys
+import time
+import timeit
+
+import rsa
+from jose import jwk, jwt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from auth.auth import JWKSCache
+
+AUDIENCE = 'benchmark'
+ISSUER = 'https://benchmark.local/'
+
+
+def make_token_and_jwks():
+    _, private_key = rsa.newkeys(2048)
+    private_pem = private_key.save_pkcs1().decode()
+    public_jwk = jwk.construct(private_pem, 'RS256').public_key().to_dict()
+    public_jwk.update({'kid': 'bench-kid', 'use': 'sig'})
+    token = jwt.encode(
+        {'sub': 'bench', 'aud': AUDIENCE, 'iss': ISSUER, 'exp': int(time.time()) + 3600},
+        private_pem, algorithm='RS256', headers={'kid': 'bench-kid'})
+    return token, {'keys': [public_jwk]}
+
+
+def decode_building_key(token, jwks):
+    unverified_header = jwt.get_unverified_header(token)
+    for key in jwks['keys']:
+        if key['kid'] == unverified_header['kid']:
+            rsa_key = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+    return jwt.decode(token, rsa_key, algorithms=['RS256'], audience=AUDIENCE, issuer=ISSUER)
+
+
+def decode_prebuilt_key(token, keys):
+    unverified_header = jwt.get_unverified_header(token)
+    public_key = keys[unverified_header['kid']][unverified_header['alg']]
+    return jwt.decode(token, public_key, algorithms=[unverified_header['alg']],
+                      audience=AUDIENCE, issuer=ISSUER)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    token, jwks = make_token_and_jwks()
+    keys = JWKSCache.build_keys(jwks)
+
+    per_request = timeit.timeit(lambda: decode_building_key(token, jwks), number=iterations)
+    prebuilt = timeit.timeit(lambda: decode_prebuilt_key(token, keys), number=iterations)
+
+    print("iterations:            {}".format(iterations))
+    print("per-request key build: {:.1f} us/op".format(per_request / iterations * 1e6))
+    print("pre-built key object:  {:.1f} us/op".format(prebuilt / iterations * 1e6))
+    print("speedup:               {:.2f}x".format(per_request / prebuilt))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+'''
+Cold-start benchmark for one worker
+Times `import app` (which runs create_app()) in fresh interpreters, the way
+each gunicorn worker boots, and the database_exists probe that setup_db used
+to run on every startup. The probe is timed in the same fresh interpreter
+right after the import, so "before" is import + probe and "after" is import alone.
+
+Uses DATABASE_URL when set, otherwise the local database from settings.py.
+    python benchmarks/bench_startup.py [runs]
+'''
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKER = '''
+import json, time
+start = time.perf_counter()
+import app
+startup = time.perf_counter() - start
+from sqlalchemy_utils import database_exists
+start = time.perf_counter()
+try:
+    database_exists(app.app.config["SQLALCHEMY_DATABASE_URI"])
+    probe = time.perf_counter() - start
+except Exception as e:
+    probe = None
+print(json.dumps({"startup": startup, "probe": probe}))
+'''
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    startups, probes = [], []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', WORKER], cwd=ROOT, check=True,
+                                capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        startups.append(result["startup"])
+        if result["probe"] is not None:
+            probes.append(result["probe"])
+
+    after = statistics.median(startups)
+    print("runs:                     {}".format(runs))
+    print("create_app, no probe:     {:.1f} ms (median)".format(after * 1000))
+    if probes:
+        probe = statistics.median(probes)
+        print("database_exists probe:    {:.1f} ms (median)".format(probe * 1000))
+        print("create_app, with probe:   {:.1f} ms (median, before)".format((after + probe) * 1000))
+    else:
+        print("database_exists probe:    database unreachable, probe not timed")
+
+
+if __name__ == '__main__':
+    main()
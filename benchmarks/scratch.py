@@ -0,0 +1,14 @@
+'''
+Scratch database of the benchmarks that delete or TRUNCATE rows
+    scratch_database_uri: DATABASE_URL, the benchmark exits when it isn't set
+'''
+import os
+import sys
+
+
+# Never falls back to the database of .env, the benchmark would empty the developer's tables
+def scratch_database_uri():
+    uri = os.environ.get("DATABASE_URL")
+    if not uri:
+        sys.exit("DATABASE_URL is not set. This benchmark deletes rows, point DATABASE_URL at a scratch database.")
+    return uri
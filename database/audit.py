@@ -0,0 +1,206 @@
+import atexit
+import json
+import queue
+import threading
+import time
+from datetime import date, datetime, timezone
+from flask import g, has_request_context
+from serialization import encode_json
+from settings import AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_INTERVAL, AUDIT_BLOCK_TIMEOUT, AUDIT_MAX_ATTEMPTS
+
+'''
+FileAuditSink
+Appends each batch of events to a local file, one JSON object per line
+'''
+class FileAuditSink:
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, events):
+        lines = ''.join(json.dumps(dict(event, at=event['at'].isoformat()), sort_keys=True) + '\n' for event in events)
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write(lines)
+
+'''
+DatabaseAuditSink
+Writes each batch of events into the audit_log table
+    uses its own connection from the engine, never the session of a request
+    on psycopg the batch is streamed with one COPY, the JSON of data encoded by orjson,
+    other drivers get one multi-row INSERT
+'''
+class DatabaseAuditSink:
+    columns = ('at', 'action', 'table_name', 'row_id', 'actor', 'data')
+
+    def __init__(self, engine, table):
+        self.engine = engine
+        self.table = table
+        self.copy_statement = "COPY {} ({}) FROM STDIN".format(table.name, ', '.join(self.columns))
+
+    def write(self, events):
+        with self.engine.begin() as connection:
+            if self.engine.dialect.driver != 'psycopg':
+                connection.execute(self.table.insert(), events)
+                return
+            with connection.connection.driver_connection.cursor() as cursor:
+                with cursor.copy(self.copy_statement) as copy:
+                    for event in events:
+                        data = event['data']
+                        copy.write_row((event['at'], event['action'], event['table_name'], event['row_id'], event['actor'],
+                                        encode_json(data, sort_keys=False, ensure_ascii=False).decode()
+                                        if data is not None else None))
+
+'''
+AuditLog
+Write-behind log of the creates, updates and deletes of movies and actors
+    record() only puts the event on a bounded in-memory queue, the request doesn't wait for the write
+    a background thread drains the queue and hands batches of up to batch_size events to the sink,
+    at the latest flush_interval seconds after the first event of the batch
+    when the queue is full, record() waits up to block_timeout seconds for room (backpressure)
+    and then drops the event, counted in `dropped`
+    a failed batch is retried every flush_interval seconds, the queue keeps filling meanwhile,
+    after max_attempts failed writes the batch is dropped and its events counted in `dropped`
+    close() writes what is left, it runs at interpreter exit and in the gunicorn worker_exit hook
+'''
+class AuditLog:
+    def __init__(self, sink=None, maxsize=AUDIT_QUEUE_SIZE, batch_size=AUDIT_BATCH_SIZE,
+                 flush_interval=AUDIT_FLUSH_INTERVAL, block_timeout=AUDIT_BLOCK_TIMEOUT, max_attempts=AUDIT_MAX_ATTEMPTS):
+        self.sink = sink
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        self.written = 0
+        self.dropped = 0
+        self.failed_batches = 0
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._stopping = False
+        self._lock = threading.Lock()
+
+    '''
+    configure(sink)
+    Writes the pending events to the current sink, then switches to the new one (None turns the log off)
+    '''
+    def configure(self, sink):
+        self.flush()
+        self.sink = sink
+
+    '''
+    record(action, table, row_id, data)
+    Queues one event: action is create, update or delete, data the values written
+        only a tuple is queued here, the event is built by the background thread
+    '''
+    def record(self, action, table, row_id, data=None):
+        self.record_many(action, table, [(row_id, data)])
+
+    '''
+    record_many(action, table, rows)
+    Queues one event per (row_id, data) of rows with a single put, used by the bulk writes
+        a full queue drops all of them
+    '''
+    def record_many(self, action, table, rows):
+        if self.sink is None or not rows:
+            return
+        self._start()
+        try:
+            self._queue.put((time.time(), action, table, current_actor(), rows), timeout=self.block_timeout)
+        except queue.Full:
+            with self._lock:
+                self.dropped += len(rows)
+            print("Audit log queue is full, events dropped", action, table, len(rows))
+
+    @staticmethod
+    def _events(recorded):
+        at, action, table, actor, rows = recorded
+        at = datetime.fromtimestamp(at, timezone.utc)
+        return [{
+            "at": at,
+            "action": action,
+            "table_name": table,
+            "row_id": row_id,
+            "actor": actor,
+            "data": {key: value.isoformat() if isinstance(value, date) else value
+                     for key, value in data.items()} if data is not None else None
+        } for row_id, data in rows]
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._stopping = False
+                    self._thread = threading.Thread(target=self._run, name="audit-log", daemon=True)
+                    self._thread.start()
+
+    # Collects a batch: blocks for its first put, then waits at most flush_interval for batch_size events
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        size = len(batch[0][-1])
+        deadline = time.monotonic() + self.flush_interval
+        while size < self.batch_size:
+            try:
+                batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+            size += len(batch[-1][-1])
+        return batch
+
+    def _run(self):
+        while not (self._stopping and self._queue.empty()):
+            batch = self._next_batch()
+            events = [event for recorded in batch for event in self._events(recorded)]
+            attempts = 0
+            while events:
+                try:
+                    self.sink.write(events)
+                    with self._lock:
+                        self.written += len(events)
+                    break
+                except Exception as e:
+                    attempts += 1
+                    with self._lock:
+                        self.failed_batches += 1
+                    if self._stopping or attempts >= self.max_attempts:
+                        with self._lock:
+                            self.dropped += len(events)
+                        print("Audit log write failed, batch of", len(events), "events dropped after", attempts, "attempts", e)
+                        break
+                    print("Audit log write failed, retrying", e)
+                    time.sleep(self.flush_interval)
+            for _ in batch:
+                self._queue.task_done()
+
+    '''
+    flush(timeout)
+    Waits until every queued event has been written, True when it made it in time
+    '''
+    def flush(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if self._thread is None or not self._thread.is_alive() or time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self, timeout=10):
+        self._stopping = True
+        self.flush(timeout)
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {"queued": self._queue.qsize(), "written": self.written,
+                    "dropped": self.dropped, "failed_batches": self.failed_batches}
+
+# Subject of the token of the current request, None outside a request
+def current_actor():
+    if not has_request_context():
+        return None
+    payload = g.get('jwt_payload')
+    return payload.get('sub') if payload else None
+
+audit_log = AuditLog()
+atexit.register(audit_log.close)
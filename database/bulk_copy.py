@@ -0,0 +1,224 @@
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+import time
+from sqlalchemy import select
+from database.audit import audit_log
+from database.cache import response_cache
+from serialization import encode_json
+from settings import COPY_CHUNK_BYTES, COPY_CHUNK_ROWS, RESPONSE_CACHE_TTL
+
+# Seconds between two progress lines
+PROGRESS_INTERVAL = 2.0
+
+'''
+CopyProgress
+Prints the rows and bytes copied so far to stderr, at most every PROGRESS_INTERVAL seconds
+    stderr keeps stdout free for an export written to '-'
+'''
+class CopyProgress:
+    def __init__(self, label, total_bytes=None):
+        self.label = label
+        self.total_bytes = total_bytes
+        self.rows = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self._printed = self.started
+
+    def add(self, rows, size):
+        self.rows += rows
+        self.bytes += size
+        now = time.monotonic()
+        if now - self._printed >= PROGRESS_INTERVAL:
+            self._printed = now
+            self.report()
+
+    def report(self, done=False):
+        elapsed = time.monotonic() - self.started
+        share = " ({:.0%})".format(self.bytes / self.total_bytes) if self.total_bytes and not done else ""
+        print("{}: {}{:,} rows, {:.1f} MB{} in {:.1f} s, {:,.0f} rows/s".format(
+            self.label, "done, " if done else "", self.rows, self.bytes / 1e6, share, elapsed,
+            self.rows / elapsed if elapsed else 0), file=sys.stderr)
+
+# NDJSON for .ndjson and .jsonl files, CSV otherwise
+def format_of(path):
+    return 'ndjson' if path.lower().endswith(('.ndjson', '.jsonl')) else 'csv'
+
+def open_input(path):
+    return sys.stdin.buffer if path == '-' else open(path, 'rb')
+
+def open_output(path):
+    return sys.stdout.buffer if path == '-' else open(path, 'wb')
+
+# Columns of a file, only distinct serialized fields of the model may be imported
+def check_columns(model, columns):
+    unknown = [column for column in columns if column not in model.serialized_fields]
+    if unknown or not columns or len(set(columns)) != len(columns):
+        raise ValueError("Columns must be distinct fields of {} ({}), got: {}".format(
+            model.__tablename__, ', '.join(model.serialized_fields), ', '.join(columns)))
+    return columns
+
+# Raw chunks of a CSV file after its header line, newlines are counted as rows for the progress
+def csv_chunks(file, chunk_bytes, progress):
+    while True:
+        chunk = file.read(chunk_bytes)
+        if not chunk:
+            return
+        progress.add(chunk.count(b'\n'), len(chunk))
+        yield chunk
+
+# Columns of an NDJSON file: the fields of the model present in its first object
+def ndjson_columns(model, first_line):
+    try:
+        item = json.loads(first_line)
+    except ValueError as e:
+        raise ValueError("Line 1 is not valid JSON: {}".format(e))
+    return check_columns(model, [field for field in model.serialized_fields if field in item])
+
+# NDJSON objects turned into CSV, chunk_rows lines at a time, for COPY ... FORMAT csv
+def ndjson_chunks(lines, columns, chunk_rows, progress):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    rows = size = 0
+    for number, line in enumerate(lines, 1):
+        size += len(line)
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            raise ValueError("Line {} is not valid JSON: {}".format(number, e))
+        writer.writerow([item.get(column) for column in columns])
+        rows += 1
+        if rows == chunk_rows:
+            progress.add(rows, size)
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            rows = size = 0
+    progress.add(rows, size)
+    yield buffer.getvalue().encode('utf-8')
+
+'''
+copy_in(cursor, statement, chunks)
+Runs COPY ... FROM STDIN on a psycopg 3 cursor and feeds it the byte chunks one at a time
+    psycopg 3 queues the data in libpq without waiting for the server, so a file loaded
+    faster than the server indexes it piles up in memory, the connection is switched to
+    blocking mode meanwhile so each chunk is sent before the next one is read
+'''
+def copy_in(cursor, statement, chunks):
+    pgconn = cursor.connection.pgconn
+    nonblocking = pgconn.nonblocking
+    pgconn.nonblocking = 0
+    try:
+        with cursor.copy(statement) as copy:
+            for chunk in chunks:
+                copy.write(chunk)
+    finally:
+        pgconn.nonblocking = nonblocking
+
+# Runs COPY ... TO STDOUT on a psycopg 3 cursor and writes its output to file as it arrives
+def copy_out(cursor, statement, file, progress):
+    with cursor.copy(statement) as copy:
+        for data in copy:
+            data = bytes(data)
+            file.write(data)
+            progress.add(data.count(b'\n'), len(data))
+
+# Opens a raw psycopg 3 cursor on the connection (see driver_uri), COPY isn't available through SQLAlchemy
+def driver_cursor(connection):
+    return connection.connection.driver_connection.cursor()
+
+'''
+load_rows(connection, model, file, file_format, progress)
+Loads a CSV (with a header line) or NDJSON binary file into the table of model with one COPY
+    the columns are the header of the CSV file, or the fields of the first NDJSON object
+    when ids are loaded the id sequence is moved past the largest one
+    runs in the transaction of the connection, returns the number of rows loaded
+'''
+def load_rows(connection, model, file, file_format, progress, chunk_bytes=COPY_CHUNK_BYTES, chunk_rows=COPY_CHUNK_ROWS):
+    table = model.__tablename__
+    first_line = file.readline()
+    if file_format == 'csv':
+        columns = check_columns(model, next(csv.reader([first_line.decode('utf-8-sig')]), []))
+        progress.add(0, len(first_line))
+        chunks = csv_chunks(file, chunk_bytes, progress)
+    else:
+        columns = ndjson_columns(model, first_line)
+        chunks = ndjson_chunks(itertools.chain([first_line], file), columns, chunk_rows, progress)
+
+    cursor = driver_cursor(connection)
+    try:
+        copy_in(cursor, "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(table, ', '.join(columns)), chunks)
+        rows = cursor.rowcount
+        if 'id' in columns:
+            cursor.execute("SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                           "coalesce((SELECT max(id) FROM {0}), 0) + 1, false)".format(table))
+        # Fresh statistics, so the planner knows how big the table has become
+        cursor.execute("ANALYZE {}".format(table))
+    finally:
+        cursor.close()
+    progress.rows = rows
+    return rows
+
+'''
+dump_rows(connection, model, file, file_format, progress)
+Writes every row of the table of model to a CSV (with a header line) or NDJSON binary file
+    CSV comes straight out of COPY ... TO STDOUT
+    NDJSON lines are the objects of the list endpoints, read with a server-side cursor
+    returns the number of rows written
+'''
+def dump_rows(connection, model, file, file_format, progress, chunk_rows=COPY_CHUNK_ROWS):
+    if file_format == 'csv':
+        cursor = driver_cursor(connection)
+        try:
+            copy_out(cursor, "COPY {} ({}) TO STDOUT WITH (FORMAT csv, HEADER)".format(
+                model.__tablename__, ', '.join(model.serialized_fields)), file, progress)
+        finally:
+            cursor.close()
+        # The header line isn't a row
+        progress.rows -= 1
+        return progress.rows
+
+    columns = [getattr(model, field) for field in model.serialized_fields]
+    result = connection.execution_options(yield_per=chunk_rows).execute(select(*columns).order_by(model.id))
+    for rows in result.partitions():
+        data = b''.join(encode_json(dict(zip(model.serialized_fields, row))) + b'\n' for row in rows)
+        file.write(data)
+        progress.add(len(rows), len(data))
+    return progress.rows
+
+'''
+import_rows(db, model, path, file_format)
+Loads a file into the table of model (load_rows) in one transaction, '-' reads stdin
+    the file is streamed in chunks, memory stays flat whatever its size
+    a bad row rolls the whole import back
+    the cached lists of the running workers are invalidated through RESPONSE_CACHE_URL,
+    without it they expire after RESPONSE_CACHE_TTL
+'''
+def import_rows(db, model, path, file_format):
+    table = model.__tablename__
+    progress = CopyProgress("import {}".format(table), os.path.getsize(path) if path != '-' else None)
+    with open_input(path) as file:
+        with db.engine.begin() as connection:
+            rows = load_rows(connection, model, file, file_format, progress)
+    progress.report(done=True)
+    # Only reaches the running workers through a shared backend, this command is a process of its own
+    response_cache.bump(table)
+    if not response_cache.is_shared:
+        print("RESPONSE_CACHE_URL is not set, running workers may serve {} from before the import "
+              "for up to {} s".format(table, RESPONSE_CACHE_TTL), file=sys.stderr)
+    audit_log.record('import', table, None, {"rows": rows, "file": path})
+    return rows
+
+# Writes every row of the table of model to a file (dump_rows), '-' writes to stdout
+def export_rows(db, model, path, file_format):
+    progress = CopyProgress("export {}".format(model.__tablename__))
+    with open_output(path) as file:
+        with db.engine.connect() as connection:
+            rows = dump_rows(connection, model, file, file_format, progress)
+    progress.report(done=True)
+    return rows
@@ -0,0 +1,211 @@
+import hashlib
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from settings import RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_URL
+
+'''
+LocalCacheBackend
+In-process LRU used for cached response bodies, and for the idempotency keys of a single worker
+    holds at most maxsize entries, the least recently used one is evicted first
+    an entry expires ttl seconds after it was set (None keeps it until evicted)
+'''
+class LocalCacheBackend:
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    # ttl in seconds, defaults to the ttl of the backend
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._store(key, value, ttl)
+
+    # Sets the key only when it's missing (or expired), True when it was set
+    def add(self, key, value, ttl=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                return False
+            self._store(key, value, ttl)
+            return True
+
+    def _store(self, key, value, ttl):
+        ttl = ttl if ttl is not None else self.ttl
+        self._entries[key] = (time.monotonic() + ttl if ttl is not None else None, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+'''
+DictSharedBackend
+In-process version store, never evicts
+    used when no shared backend is configured, i.e. a single worker, it only holds the collection versions
+    also the fake shared backend in tests: two ResponseCache objects given
+    the same instance behave like two workers sharing Redis
+'''
+class DictSharedBackend:
+    def __init__(self):
+        self._values = {}
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            with self._lock:
+                self._values.pop(key, None)
+                self._expires.pop(key, None)
+            return None
+        return self._values.get(key)
+
+    # ttl in seconds, an expired key is dropped when read
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._values[key] = value
+            if ttl is None:
+                self._expires.pop(key, None)
+            else:
+                self._expires[key] = time.monotonic() + ttl
+
+    # Sets the key only when it's missing (or expired), True when it was set
+    def add(self, key, value, ttl=None):
+        with self._lock:
+            now = time.monotonic()
+            expires = self._expires.get(key)
+            if key in self._values and (expires is None or expires > now):
+                return False
+            self._values[key] = value
+            if ttl is None:
+                self._expires.pop(key, None)
+            else:
+                self._expires[key] = now + ttl
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+            self._expires.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            self._values[key] = int(self._values.get(key, 0)) + 1
+            return self._values[key]
+
+'''
+RedisSharedBackend
+Keeps the collection versions in Redis so every worker sees a write straight away
+    needs the optional `redis` package
+'''
+class RedisSharedBackend:
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("RESPONSE_CACHE_URL is set but the redis package is not installed")
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self._client.get(key)
+
+    def set(self, key, value, ttl=None):
+        self._client.set(key, value, px=int(ttl * 1000) if ttl is not None else None)
+
+    def add(self, key, value, ttl=None):
+        return bool(self._client.set(key, value, nx=True, px=int(ttl * 1000) if ttl is not None else None))
+
+    def delete(self, key):
+        self._client.delete(key)
+
+    def incr(self, key):
+        return self._client.incr(key)
+
+'''
+ResponseCache
+Caches serialized list responses per collection version
+    every write to a collection bumps its version, so cached entries go stale at once
+    ETags are derived from the version and the request, no query is needed to answer 304
+    versions live in the shared backend, bodies always stay in the local LRU for at most RESPONSE_CACHE_TTL
+    run several workers with a Redis shared backend, otherwise a write only
+    invalidates the cache of the worker that served it
+    without a shared backend the versions restart at 0 with the process, so its ETags carry a
+    per-process boot id, and a 304 is only answered while the body is still cached (is_shared)
+'''
+class ResponseCache:
+    def __init__(self, local=None, shared=None):
+        self.local = local if local is not None else LocalCacheBackend(ttl=RESPONSE_CACHE_TTL)
+        self.is_shared = shared is not None
+        self.shared = shared if shared is not None else DictSharedBackend()
+        self.boot_id = None if self.is_shared else secrets.token_hex(4)
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, collection):
+        return int(self.shared.get('version:' + collection) or 0)
+
+    def bump(self, collection):
+        self.shared.set('bumped:' + collection, time.time())
+        return self.shared.incr('version:' + collection)
+
+    # True when one of the collections was written in the last `seconds`
+    def changed_within(self, collections, seconds):
+        if isinstance(collections, str):
+            collections = (collections,)
+        now = time.time()
+        return any(now - float(self.shared.get('bumped:' + name) or 0) < seconds for name in collections)
+
+    def etag(self, collections, variant):
+        # A response built from several collections goes stale when any of them changes
+        if isinstance(collections, str):
+            collections = (collections,)
+        versions = '-'.join('{}{}'.format(name, self.version(name)) for name in collections)
+        digest = hashlib.sha1(variant.encode('utf-8')).hexdigest()[:16]
+        if self.boot_id is not None:
+            return '{}-{}-{}'.format(self.boot_id, versions, digest)
+        return '{}-{}'.format(versions, digest)
+
+    # True when If-None-Match may be answered with 304: always with a shared backend,
+    # otherwise only while the body is cached, so a worker that missed a write is stale for RESPONSE_CACHE_TTL at most
+    def revalidates(self, etag):
+        return self.is_shared or self.local.get('body:' + etag) is not None
+
+    def get(self, etag):
+        body = self.local.get('body:' + etag)
+        if body is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return body
+
+    def set(self, etag, body):
+        self.local.set('body:' + etag, body)
+
+
+response_cache = ResponseCache(
+    LocalCacheBackend(ttl=RESPONSE_CACHE_TTL),
+    RedisSharedBackend(RESPONSE_CACHE_URL) if RESPONSE_CACHE_URL else None
+)
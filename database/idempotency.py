@@ -0,0 +1,82 @@
+import hashlib
+import json
+import time
+from flask import g, request
+from database.cache import LocalCacheBackend, response_cache
+from settings import IDEMPOTENCY_TTL, IDEMPOTENCY_WAIT_SECONDS, IDEMPOTENCY_CACHE_SIZE
+
+# Seconds a key stays claimed by a request that never finishes (e.g. its worker was killed)
+PENDING_TTL = 60
+# Longest key accepted in the Idempotency-Key header
+MAX_KEY_LENGTH = 255
+
+'''
+IdempotencyStore
+Responses of the POST requests sent with an Idempotency-Key header, replayed to retries
+    entries live in the response cache's shared backend, so with Redis every worker sees them
+    without Redis they live in a bounded LRU of the worker (IDEMPOTENCY_CACHE_SIZE keys), and a retry
+    or a concurrent request served by another worker runs again: only Redis guarantees a single insert
+    a key is scoped to the client (`sub` of its token, so a refreshed token keeps its keys) and the path
+    the first request claims its key with an atomic add, so of two concurrent requests
+    with the same key only one runs, the other waits for its response
+    the request body is fingerprinted, a key reused with another body is refused
+'''
+class IdempotencyStore:
+    def __init__(self, shared, ttl=IDEMPOTENCY_TTL, wait=IDEMPOTENCY_WAIT_SECONDS):
+        self.shared = shared
+        self.ttl = ttl
+        self.wait = wait
+
+    @staticmethod
+    def key(idempotency_key):
+        scope = '\n'.join((client_id(), request.path, idempotency_key))
+        return 'idempotency:' + hashlib.sha256(scope.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def fingerprint():
+        return hashlib.sha256(request.get_data()).hexdigest()
+
+    '''
+    claim(key, fingerprint)
+    Returns None when this request now holds the key and has to run,
+    otherwise the entry of the request that holds it: {"fingerprint", "status", "body", "etag"},
+    status is None while that request is still running after `wait` seconds
+    '''
+    def claim(self, key, fingerprint):
+        pending = json.dumps({"fingerprint": fingerprint, "status": None})
+        deadline = time.monotonic() + self.wait
+        while True:
+            if self.shared.add(key, pending, ttl=PENDING_TTL):
+                return None
+            entry = self.shared.get(key)
+            if entry is None:
+                # Released or expired in the meantime, try to claim it again
+                continue
+            entry = json.loads(entry)
+            if entry["status"] is not None or entry["fingerprint"] != fingerprint or time.monotonic() >= deadline:
+                return entry
+            time.sleep(0.05)
+
+    # Keeps the response of the request holding the key for the retries
+    def complete(self, key, fingerprint, response):
+        self.shared.set(key, json.dumps({
+            "fingerprint": fingerprint,
+            "status": response.status_code,
+            "body": response.get_data(as_text=True),
+            "etag": response.headers.get('ETag')
+        }), ttl=self.ttl)
+
+    # Frees the key of a request that failed, a retry runs again
+    def release(self, key):
+        self.shared.delete(key)
+
+# Subject of the verified token (requires_auth runs first), the Authorization header without one
+def client_id():
+    payload = g.get('jwt_payload')
+    if payload and payload.get('sub'):
+        return 'sub:' + payload['sub']
+    return 'authorization:' + request.headers.get('Authorization', '')
+
+idempotency_store = IdempotencyStore(
+    response_cache.shared if response_cache.is_shared else LocalCacheBackend(IDEMPOTENCY_CACHE_SIZE)
+)
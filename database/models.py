@@ -1,46 +1,470 @@
 import os
-from sqlalchemy import ForeignKey, Column, String, Integer, DateTime, create_engine
+from sqlalchemy import ForeignKey, Column, String, Integer, DateTime, DDL, Index, create_engine, event, literal_column, \
+    inspect
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
 from sqlalchemy.orm import relationship
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+from flask_migrate import Migrate, upgrade, stamp
 from sqlalchemy_utils import database_exists, create_database
-from settings import DB_NAME, DB_USER, DB_PASSWORD, DB_HOST
+from settings import DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, EXPORT_BATCH_SIZE, \
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING, QUERY_COUNT_HEADER, \
+    AUDIT_LOG, AUDIT_LOG_PATH
+from database.audit import audit_log, DatabaseAuditSink, FileAuditSink
+from database.cache import response_cache
+from database.pool import InstrumentedQueuePool
+from database.profiling import setup_query_profiling
+from database.replicas import RoutingSession, setup_read_replicas
 
 import json
+from datetime import date
 
-db = SQLAlchemy()
+# Reads of GET requests may be routed to a replica, see database/replicas.py
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+# Postgres URLs always name the psycopg 3 driver, whatever the default of the installed SQLAlchemy:
+# the import and export commands use its COPY API, and it cooperates with gevent (SERVING_MODE=async)
+def driver_uri(path):
+    for scheme in ("postgres://", "postgresql://"):
+        if path.startswith(scheme):
+            return "postgresql+psycopg://" + path[len(scheme):]
+    return path
 
 # Setting up DB config using path
-def setup_db(app,database_path):
+# replica_paths are optional read replicas of database_path, GET requests read from them
+def setup_db(app,database_path, replica_paths=()):
+    database_path = driver_uri(database_path)
+    replica_paths = [driver_uri(path) for path in replica_paths]
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-    
-    # Creating DB if it doesn't already exist
-    if not database_exists(database_path):
-        create_database(database_path)
-    
+    # Pool sizing and failover behaviour, see settings.py
+    engine_options = {}
+    if database_path.startswith("postgres"):
+        engine_options = {
+            "poolclass": InstrumentedQueuePool,
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "pool_timeout": DB_POOL_TIMEOUT,
+            "pool_recycle": DB_POOL_RECYCLE,
+            "pool_pre_ping": DB_POOL_PRE_PING
+        }
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
+    # One bind per replica, with the same engine options as the primary
+    # Flask-SQLAlchemy only applies SQLALCHEMY_ENGINE_OPTIONS to the primary, so each bind carries its own copy
+    app.config["SQLALCHEMY_BINDS"] = {"replica_{}".format(index): dict(engine_options, url=path)
+                                      for index, path in enumerate(replica_paths)}
+
+    # No connection is opened here, the engine connects on the first query.
+    # The database itself is created by the bootstrap-db command (bootstrap_db)
     db.app = app
     db.init_app(app)
 
+    # Per-request query counts, the slow query log and the X-Query-Count header
+    app.config.setdefault("QUERY_COUNT_HEADER", QUERY_COUNT_HEADER)
+    setup_query_profiling(app)
+
+    if replica_paths:
+        setup_read_replicas(app, app.config["SQLALCHEMY_BINDS"])
+
+    # Write-behind audit trail of every write to movies and actors
+    if AUDIT_LOG == "database":
+        with app.app_context():
+            audit_log.configure(DatabaseAuditSink(db.engine, audit_log_table))
+    elif AUDIT_LOG == "file":
+        audit_log.configure(FileAuditSink(AUDIT_LOG_PATH))
+    else:
+        audit_log.configure(None)
+
+# Alembic scripts of the schema, found whatever the working directory
+MIGRATIONS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+# Newest migration already applied to tables made by db.create_all() before the migrations took over,
+# told apart by the schema objects each revision added
+def legacy_revision(inspector):
+    if inspector.has_table('audit_log'):
+        return '5e0b2a7d3c18'
+    if 'version' in [column['name'] for column in inspector.get_columns('movies')]:
+        return 'c7d1f0a94e21'
+    if 'ix_movies_release_date' in [index['name'] for index in inspector.get_indexes('movies')]:
+        return '2675ae0beb4f'
+    return 'b38439e2e0ed'
+
+# Creating DB if it doesn't already exist, and bringing its tables up to date with the migrations
+# Run once per deployment through `flask --app app bootstrap-db`, never at app startup
+# Tables made by create_all() (older bootstrap-db) are stamped with the revision they match first
+def bootstrap_db(database_path):
+    if not database_exists(database_path):
+        print("Creating database", database_path.rsplit("/", 1)[-1])
+        create_database(database_path)
+    inspector = inspect(db.engine)
+    if inspector.has_table('movies') and not inspector.has_table('alembic_version'):
+        revision = legacy_revision(inspector)
+        print("Tables were created without migrations, stamping them with revision", revision)
+        # The first tables had no casting, it belongs to the initial revision
+        casting.create(db.engine, checkfirst=True)
+        stamp(directory=MIGRATIONS_DIRECTORY, revision=revision)
+    upgrade(directory=MIGRATIONS_DIRECTORY)
+
+# Lets the database waits of SERVING_MODE=async yield to other greenlets
+# psycopg 3 picks a gevent-friendly wait function by itself when it is imported after gevent patched select,
+# which the gevent worker does before loading the app, this checks that it happened
+def setup_async_io():
+    try:
+        from gevent import monkey
+    except ImportError:
+        raise RuntimeError("SERVING_MODE=async needs the gevent package")
+    from psycopg import waiting
+    if not monkey.is_module_patched('select') or waiting.wait is getattr(waiting, 'wait_c', None):
+        print("WARNING: SERVING_MODE=async outside a gevent worker, database waits block the process")
+
 def setup_migrations(app):
-    migrate = Migrate(app, db)
+    migrate = Migrate(app, db, directory=MIGRATIONS_DIRECTORY)
 
 # DROP and CREATE tables for test
 def create_tables_for_test():
     db.drop_all()
     db.create_all()
 
+# Column values of a flushed instance, read before commit expires them
+def row_values(instance):
+    return {field: getattr(instance, field) for field in instance.serialized_fields}
+
+# Columns changed on an instance since it was loaded, read before commit
+def changed_values(instance):
+    state = inspect(instance)
+    return {field: state.attrs[field].history.added[0] for field in instance.serialized_fields
+            if state.attrs[field].history.added}
+
+# Turns a plain row tuple into the same dict serialized_movie/serialized_actor build
+def serialize_row(fields, row):
+    return {field: value.isoformat() if isinstance(value, date) else value
+            for field, value in zip(fields, row)}
+
+'''
+select_rows(model, fields, filters, after_id, limit)
+Reads the given columns of the rows matching filters, ordered by id
+    no ORM objects are built, each row becomes a dict of plain values
+    dates are left as date objects, the JSON encoder formats them (serialization.py)
+'''
+def select_rows(model, fields, filters=(), after_id=None, limit=None):
+    columns = [getattr(model, field) for field in fields]
+    statement = db.select(*columns).where(*filters).order_by(model.id)
+    if after_id is not None:
+        statement = statement.where(model.id > after_id)
+    if limit is not None:
+        statement = statement.limit(limit)
+    return [dict(zip(fields, row)) for row in db.session.execute(statement)]
+
+'''
+keyset_page(model, fields, after_id, limit, filters)
+Reads one page of rows ordered by id, starting after `after_id`
+    only the requested columns are selected, see select_rows
+    filters are extra WHERE criteria, e.g. from the list endpoint query parameters
+    returns the rows and the cursor for the next page (None on the last page)
+'''
+def keyset_page(model, fields, after_id=None, limit=100, filters=()):
+    page = select_rows(model, fields, filters, after_id, limit)
+    next_cursor = page[-1]['id'] if len(page) == limit else None
+    return page, next_cursor
+
+'''
+stream_all(model, batch_size)
+Yields every row of the table ordered by id
+    rows come from a server-side cursor `batch_size` at a time,
+    so memory stays flat whatever the table size
+'''
+def stream_all(model, batch_size=EXPORT_BATCH_SIZE):
+    statement = db.select(model).order_by(model.id).execution_options(yield_per=batch_size)
+    for record in db.session.execute(statement).scalars():
+        yield record
+
+# Error entry reported for one item of a bulk request
+def bulk_error(index, error, message):
+    return {"index": index, "error": error, "message": message}
+
+'''
+bulk_insert(model, rows)
+Inserts validated rows with a single multi-row INSERT ... RETURNING and one commit
+    rows: list of (index, values) pairs, index is the position in the request body
+    if the batch statement fails, each row is retried in its own SAVEPOINT
+    so one bad row is reported without aborting the others
+    returns (created, errors), created holds the serialized rows in request order
+'''
+def bulk_insert(model, rows):
+    created, errors = [], []
+    if not rows:
+        return created, errors
+
+    columns = [getattr(model, field) for field in model.serialized_fields]
+    statement = db.insert(model).returning(*columns, sort_by_parameter_order=True)
+    try:
+        with db.session.begin_nested():
+            result = db.session.execute(statement, [values for _, values in rows]).all()
+        created = [serialize_row(model.serialized_fields, row) for row in result]
+    except Exception as e:
+        print("Bulk INSERT failed, retrying row by row", e)
+        for index, values in rows:
+            try:
+                with db.session.begin_nested():
+                    row = db.session.execute(statement, [values]).one()
+                created.append(serialize_row(model.serialized_fields, row))
+            except Exception as e:
+                print("Error occured while during INSERT of item", index, e)
+                errors.append(bulk_error(index, 422, "Request cannot be processed"))
+    db.session.commit()
+    response_cache.bump(model.__tablename__)
+    audit_log.record_many('create', model.__tablename__, [(row['id'], row) for row in created])
+    return created, errors
+
+'''
+bulk_update(model, rows)
+Applies partial updates by primary key in one transaction
+    rows: list of (index, values) pairs, values must contain 'id'
+    ids are checked with one SELECT, unknown ids are reported as 404
+    like bulk_insert, a failed batch UPDATE is retried row by row in SAVEPOINTs,
+    if the SELECT itself fails every item is reported as 422
+    returns (updated ids, errors)
+'''
+def bulk_update(model, rows):
+    errors = []
+    if not rows:
+        return [], errors
+
+    ids = [values['id'] for _, values in rows]
+    try:
+        with db.session.begin_nested():
+            existing = set(db.session.execute(db.select(model.id).where(model.id.in_(ids))).scalars())
+    except Exception as e:
+        print("Bulk SELECT of the ids to update failed", e)
+        return [], [bulk_error(index, 422, "Request cannot be processed") for index, _ in rows]
+    found = []
+    for index, values in rows:
+        if values['id'] in existing:
+            found.append((index, values))
+        else:
+            errors.append(bulk_error(index, 404, "Resource not found"))
+
+    updated = [values['id'] for _, values in found]
+    try:
+        with db.session.begin_nested():
+            if found:
+                db.session.execute(db.update(model), [values for _, values in found])
+    except Exception as e:
+        print("Bulk UPDATE failed, retrying row by row", e)
+        updated = []
+        for index, values in found:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(db.update(model), [values])
+                updated.append(values['id'])
+            except Exception as e:
+                print("Error occured while during UPDATE of item", index, e)
+                errors.append(bulk_error(index, 422, "Request cannot be processed"))
+    db.session.commit()
+    response_cache.bump(model.__tablename__)
+    changes = {values['id']: values for _, values in found}
+    audit_log.record_many('update', model.__tablename__, [(id, changes[id]) for id in updated])
+    return updated, errors
+
+'''
+update_versioned(model, id, values, versions=None)
+Updates one row with a single UPDATE ... WHERE id = ? [AND version IN (...)] RETURNING statement
+    versions are the row versions the client last saw (If-Match), None updates any version
+    the version is bumped by the same statement, so a concurrent update can't be lost
+    returns the serialized row and its new version, or (None, None) when no row matched
+'''
+def update_versioned(model, id, values, versions=None):
+    columns = [getattr(model, field) for field in model.serialized_fields]
+    statement = db.update(model).where(model.id == id) \
+        .values(version=model.version + 1, **values) \
+        .returning(*columns, model.version) \
+        .execution_options(synchronize_session=False)
+    if versions is not None:
+        statement = statement.where(model.version.in_(versions))
+    row = db.session.execute(statement).one_or_none()
+    db.session.commit()
+    if row is None:
+        return None, None
+    response_cache.bump(model.__tablename__)
+    audit_log.record('update', model.__tablename__, id, dict(values, version=row[-1]))
+    return serialize_row(model.serialized_fields, row[:-1]), row[-1]
+
+# Reads one row and its version like update_versioned, without changing it
+def select_versioned(model, id, versions=None):
+    columns = [getattr(model, field) for field in model.serialized_fields]
+    statement = db.select(*columns, model.version).where(model.id == id)
+    if versions is not None:
+        statement = statement.where(model.version.in_(versions))
+    row = db.session.execute(statement).one_or_none()
+    if row is None:
+        return None, None
+    return serialize_row(model.serialized_fields, row[:-1]), row[-1]
+
+'''
+delete_by_id(model, id)
+Deletes one row with a single DELETE ... WHERE id = ? RETURNING id statement
+    its casting rows go with it through ON DELETE CASCADE
+    returns True when the row existed
+'''
+def delete_by_id(model, id):
+    statement = db.delete(model).where(model.id == id).returning(model.id) \
+        .execution_options(synchronize_session=False)
+    deleted = db.session.execute(statement).scalar_one_or_none() is not None
+    db.session.commit()
+    if deleted:
+        response_cache.bump(model.__tablename__)
+        audit_log.record('delete', model.__tablename__, id)
+    return deleted
+
+'''
+bulk_delete(model, rows)
+Deletes all ids with a single DELETE ... WHERE id IN (...) RETURNING id
+    rows: list of (index, id) pairs, index is the position in the request body
+    if the batch statement fails, each id is retried in its own SAVEPOINT like bulk_insert
+    returns (deleted ids, errors), ids that did not exist are reported as 404
+'''
+def bulk_delete(model, rows):
+    errors = []
+    if not rows:
+        return [], errors
+
+    statement = db.delete(model).where(model.id.in_([id for _, id in rows])).returning(model.id)
+    try:
+        with db.session.begin_nested():
+            deleted = set(db.session.execute(statement).scalars())
+    except Exception as e:
+        print("Bulk DELETE failed, retrying row by row", e)
+        deleted = set()
+        for index, id in rows:
+            try:
+                with db.session.begin_nested():
+                    deleted.update(db.session.execute(
+                        db.delete(model).where(model.id == id).returning(model.id)).scalars())
+            except Exception as e:
+                print("Error occured while during DELETE of item", index, e)
+                errors.append(bulk_error(index, 422, "Request cannot be processed"))
+    db.session.commit()
+    response_cache.bump(model.__tablename__)
+    audit_log.record_many('delete', model.__tablename__, [(id, None) for id in deleted])
+    failed = {error['index'] for error in errors}
+    errors += [bulk_error(index, 404, "Resource not found")
+               for index, id in rows if id not in deleted and index not in failed]
+    return [id for _, id in rows if id in deleted], sorted(errors, key=lambda error: error['index'])
+
+'''
+add_casting(movie_id, actor_id)
+Casts the actor in the movie with one INSERT ... ON CONFLICT DO NOTHING, no relationship is loaded
+    when the row is new the movie version is bumped in the same transaction
+    returns True when the actor was cast, False when it already was,
+    an unknown movie or actor raises IntegrityError (foreign key)
+'''
+def add_casting(movie_id, actor_id):
+    statement = pg_insert(casting).values(movie_id=movie_id, actor_id=actor_id) \
+        .on_conflict_do_nothing().returning(casting.c.movie_id)
+    added = db.session.execute(statement).scalar_one_or_none() is not None
+    if added:
+        db.session.execute(db.update(Movie).where(Movie.id == movie_id).values(version=Movie.version + 1)
+                           .execution_options(synchronize_session=False))
+    db.session.commit()
+    if added:
+        casting_changed('create', movie_id, actor_id)
+    return added
+
+'''
+remove_casting(movie_id, actor_id)
+Removes the actor from the movie with one DELETE ... RETURNING, and bumps the movie version
+    returns False when the actor wasn't cast in the movie (or the movie doesn't exist)
+'''
+def remove_casting(movie_id, actor_id):
+    statement = db.delete(casting).where(casting.c.movie_id == movie_id, casting.c.actor_id == actor_id) \
+        .returning(casting.c.movie_id)
+    removed = db.session.execute(statement).scalar_one_or_none() is not None
+    if removed:
+        db.session.execute(db.update(Movie).where(Movie.id == movie_id).values(version=Movie.version + 1)
+                           .execution_options(synchronize_session=False))
+    db.session.commit()
+    if removed:
+        casting_changed('delete', movie_id, actor_id)
+    return removed
+
+# Both lists embed the casting (?include=), the audit event is one of the casting table
+def casting_changed(action, movie_id, actor_id):
+    response_cache.bump(Movie.__tablename__)
+    response_cache.bump(Actor.__tablename__)
+    audit_log.record(action, casting.name, movie_id, {"movie_id": movie_id, "actor_id": actor_id})
+
+'''
+attach_related(page, model, relation)
+Adds the related rows (e.g. a movie's 'actors') to each serialized row of page
+    uses one query for the whole page whatever its size, no ORM objects are built
+    related rows are plain dicts like the ones of select_rows
+'''
+def attach_related(page, model, relation):
+    attribute = getattr(model, relation)
+    target = attribute.property.mapper.class_
+    related = {row['id']: [] for row in page}
+    if related:
+        columns = [getattr(target, field) for field in target.serialized_fields]
+        statement = db.select(model.id, *columns).join_from(model, target, attribute) \
+            .where(model.id.in_(list(related))).order_by(target.id)
+        for row in db.session.execute(statement):
+            related[row[0]].append(dict(zip(target.serialized_fields, row[1:])))
+    for row in page:
+        row[relation] = related[row['id']]
+    return page
+
+'''
+Casting association table
+Which actor is cast in which movie
+    the primary key (movie_id, actor_id) indexes movie_id, ix_casting_actor_id covers lookups by actor
+'''
+casting = db.Table(
+    'casting',
+    Column('movie_id', db.Integer(), ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', db.Integer(), ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True),
+    db.Index('ix_casting_actor_id', 'actor_id')
+)
+
+'''
+Audit log table
+One row per create, update or delete of a movie or actor, written in batches by database/audit.py
+    data holds the values written, None for a delete
+'''
+audit_log_table = db.Table(
+    'audit_log',
+    Column('id', db.BigInteger().with_variant(db.Integer(), 'sqlite'), primary_key=True),
+    Column('at', db.DateTime(timezone=True), nullable=False),
+    Column('action', db.String(10), nullable=False),
+    Column('table_name', db.String(), nullable=False),
+    Column('row_id', db.Integer()),
+    Column('actor', db.String()),
+    Column('data', db.JSON(none_as_null=True).with_variant(JSONB(none_as_null=True), 'postgresql')),
+    db.Index('ix_audit_log_table_name_row_id', 'table_name', 'row_id')
+)
+
 '''
 Movie Class
 '''
 class Movie(db.Model):
     __tablename__ = 'movies'
+    # Indexes for the list filters, same as migration 2675ae0beb4f
+    __table_args__ = (
+        Index('ix_movies_release_date', 'release_date'),
+        Index('ix_movies_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+    )
+    # Columns a client may ask for with ?fields=
+    serialized_fields = ('id', 'name', 'release_date')
     # Autoincrementing, unique primary key
     id = Column(db.Integer(),primary_key=True)
     # String Movie Name
     name = Column(db.String())
     # Date Time Movie Release date 
     release_date= Column(db.Date())
+    # Row version for optimistic concurrency (If-Match on PATCH), every UPDATE bumps it
+    version = Column(db.Integer(), nullable=False, default=1, server_default='1',
+                     onupdate=literal_column('version') + 1)
+    # Actors cast in the movie, rows are removed by the database's ON DELETE CASCADE
+    actors = relationship('Actor', secondary=casting, back_populates='movies',
+                          order_by='Actor.id', passive_deletes=True)
 
     # Self initialize the variables 
     def __init__(self, name, release_date):
@@ -49,14 +473,24 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
+        db.session.flush()
+        values = row_values(self)
         db.session.commit()
+        response_cache.bump(self.__tablename__)
+        audit_log.record('create', self.__tablename__, values['id'], values)
 
     def delete(self):
+        id = self.id
         db.session.delete(self)
         db.session.commit()
+        response_cache.bump(self.__tablename__)
+        audit_log.record('delete', self.__tablename__, id)
 
     def update(self):
+        id, changes = self.id, changed_values(self)
         db.session.commit()
+        response_cache.bump(self.__tablename__)
+        audit_log.record('update', self.__tablename__, id, changes)
 
     def serialized_movie(self):
         return {
@@ -78,6 +512,14 @@ Actors Class
 class Actor(db.Model):
 
     __tablename__ = 'actors'
+    # Indexes for the list filters, same as migration 2675ae0beb4f
+    __table_args__ = (
+        Index('ix_actors_age', 'age'),
+        Index('ix_actors_gender_age', 'gender', 'age'),
+        Index('ix_actors_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+    )
+    # Columns a client may ask for with ?fields=
+    serialized_fields = ('id', 'name', 'age', 'gender')
 
     # Autoincrementing, unique primary key
     id = Column(db.Integer(), primary_key=True)
@@ -87,6 +529,12 @@ class Actor(db.Model):
     age = Column(db.Integer())
     # Integer Actor's Gender
     gender = Column(db.String())
+    # Row version for optimistic concurrency (If-Match on PATCH), every UPDATE bumps it
+    version = Column(db.Integer(), nullable=False, default=1, server_default='1',
+                     onupdate=literal_column('version') + 1)
+    # Movies the actor is cast in
+    movies = relationship('Movie', secondary=casting, back_populates='actors',
+                          order_by='Movie.id', passive_deletes=True)
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -95,14 +543,24 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
+        db.session.flush()
+        values = row_values(self)
         db.session.commit()
+        response_cache.bump(self.__tablename__)
+        audit_log.record('create', self.__tablename__, values['id'], values)
 
     def update(self):
+        id, changes = self.id, changed_values(self)
         db.session.commit()
+        response_cache.bump(self.__tablename__)
+        audit_log.record('update', self.__tablename__, id, changes)
 
     def delete(self):
+        id = self.id
         db.session.delete(self)
         db.session.commit()
+        response_cache.bump(self.__tablename__)
+        audit_log.record('delete', self.__tablename__, id)
 
     def serialized_actor(self):
         return (
@@ -118,4 +576,8 @@ class Actor(db.Model):
             'name': self.name,
             'age': self.age,
             'gender': self.gender,
-        }
\ No newline at end of file
+        }
+
+# The trigram indexes need pg_trgm, create_all doesn't install extensions by itself
+event.listen(db.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
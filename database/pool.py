@@ -0,0 +1,88 @@
+import threading
+import time
+from sqlalchemy import exc, text
+from sqlalchemy.pool import QueuePool
+
+'''
+PoolWaitStats
+Counts connection checkouts and the time spent waiting for them
+'''
+class PoolWaitStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, wait, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += int(timed_out)
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": round(self.total_wait, 6),
+                "wait_seconds_max": round(self.max_wait, 6),
+                "wait_seconds_avg": round(self.total_wait / self.checkouts, 6) if self.checkouts else 0.0
+            }
+
+'''
+InstrumentedQueuePool
+QueuePool that records how long each checkout waited for a connection
+    the wait includes opening a new connection when the pool grows
+    only a checkout that gave up after pool_timeout counts as a timeout, a failed connect is re-raised as is
+'''
+class InstrumentedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = PoolWaitStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.wait_stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.wait_stats.record(time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        # Keep the counters when the pool is recreated after a failover
+        pool = super().recreate()
+        pool.wait_stats = self.wait_stats
+        return pool
+
+# Snapshot of the engine's pool: configured size, checked out and idle connections, wait times
+def pool_status(engine):
+    pool = engine.pool
+    status = {"pool_class": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "idle": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "timeout": pool.timeout()
+        })
+    if isinstance(pool, InstrumentedQueuePool):
+        status.update(pool.wait_stats.as_dict())
+    return status
+
+# Runs SELECT 1 on the engine itself, so the probe and the pool it reports belong to the same database
+def engine_health(engine):
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        healthy = True
+    except Exception as e:
+        print("Database health check failed", engine.url.render_as_string(hide_password=True), e)
+        healthy = False
+    # Taken once the probe's connection is back in the pool
+    return healthy, pool_status(engine)
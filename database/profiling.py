@@ -0,0 +1,128 @@
+import threading
+import time
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from metrics import add_phase_time
+from settings import SLOW_QUERY_MS
+
+# Statements PostgreSQL can EXPLAIN without running them
+EXPLAINABLE_STATEMENTS = ('select', 'insert', 'update', 'delete', 'with')
+# Transaction control sent as statements, not counted, like BEGIN and COMMIT which never reach a cursor
+SAVEPOINT_STATEMENTS = ('SAVEPOINT ', 'RELEASE SAVEPOINT ', 'ROLLBACK TO SAVEPOINT ')
+
+'''
+QueryProfiler
+Engine event listeners counting and timing every SQL statement
+    the count and time of the statements of a request are kept in flask.g
+    statements slower than slow_query_ms are printed with their parameters and EXPLAIN plan
+'''
+class QueryProfiler:
+    def __init__(self, slow_query_ms=SLOW_QUERY_MS):
+        self.slow_query_seconds = slow_query_ms / 1000.0 if slow_query_ms > 0 else None
+        self.slow_queries = 0
+        self._lock = threading.Lock()
+
+    '''
+    install()
+    Listens on every Engine, so replicas and the test engines are profiled too
+    '''
+    def install(self):
+        if not event.contains(Engine, 'before_cursor_execute', self.before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+            event.listen(Engine, 'handle_error', self.handle_error)
+
+    # The start time is kept on the connection, statements of one connection never overlap
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('query_start_time')
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        if statement.startswith(SAVEPOINT_STATEMENTS):
+            return
+        self.record(elapsed)
+        if self.slow_query_seconds is not None and elapsed >= self.slow_query_seconds:
+            self.log_slow_query(conn, cursor, statement, parameters, executemany, elapsed)
+
+    def handle_error(self, exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get('query_start_time'):
+            self.record(time.perf_counter() - connection.info['query_start_time'].pop())
+
+    # Adds one statement to the current request, nothing is kept outside a request
+    def record(self, elapsed):
+        if not has_request_context():
+            return
+        g.query_count = g.get('query_count', 0) + 1
+        g.query_seconds = g.get('query_seconds', 0.0) + elapsed
+        add_phase_time('db', elapsed)
+
+    def log_slow_query(self, conn, cursor, statement, parameters, executemany, elapsed):
+        with self._lock:
+            self.slow_queries += 1
+        print("Slow query ({:.1f} ms): {}".format(elapsed * 1000, statement))
+        print("Parameters:", parameters)
+        plan = self.explain(conn, cursor, statement, parameters, executemany)
+        if plan:
+            print("Plan:\n" + plan)
+
+    '''
+    explain(conn, cursor, statement, parameters, executemany)
+    Returns the EXPLAIN plan of a statement, run on a raw cursor of the same connection
+    so it doesn't go through the engine events again. None when it can't be explained
+        inside a transaction the EXPLAIN runs in a SAVEPOINT, a failed EXPLAIN is rolled back
+        to it instead of aborting the transaction of the request
+    '''
+    @staticmethod
+    def explain(conn, cursor, statement, parameters, executemany):
+        if executemany or conn.dialect.name != 'postgresql':
+            return None
+        if not statement.lstrip().lower().startswith(EXPLAINABLE_STATEMENTS):
+            return None
+        savepoint = not getattr(cursor.connection, 'autocommit', False)
+        try:
+            explain_cursor = cursor.connection.cursor()
+            try:
+                if savepoint:
+                    explain_cursor.execute("SAVEPOINT slow_query_explain")
+                try:
+                    explain_cursor.execute("EXPLAIN " + statement, parameters or None)
+                    plan = '\n'.join(row[0] for row in explain_cursor.fetchall())
+                except Exception:
+                    if savepoint:
+                        explain_cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                    raise
+                if savepoint:
+                    explain_cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+                return plan
+            finally:
+                explain_cursor.close()
+        except Exception as e:
+            print("EXPLAIN of slow query failed", e)
+            return None
+
+query_profiler = QueryProfiler()
+
+'''
+setup_query_profiling(app)
+Installs the query profiler and resets the counts at the start of each request
+    debug responses, or all of them with QUERY_COUNT_HEADER, carry the number of
+    statements run by the request in an X-Query-Count header
+'''
+def setup_query_profiling(app, profiler=query_profiler):
+    profiler.install()
+
+    @app.before_request
+    def reset_query_count():
+        g.query_count = 0
+        g.query_seconds = 0.0
+
+    @app.after_request
+    def add_query_count_header(response):
+        if app.debug or app.config.get("QUERY_COUNT_HEADER"):
+            response.headers["X-Query-Count"] = str(g.get('query_count', 0))
+        return response
@@ -0,0 +1,113 @@
+import hashlib
+import itertools
+import threading
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from database.cache import LocalCacheBackend, response_cache
+from settings import REPLICA_STRATEGY, READ_YOUR_WRITES_SECONDS, WEB_CONCURRENCY
+
+# Requests that only read and may be served by a replica
+READ_METHODS = ('GET', 'HEAD')
+# Clients remembered by a single worker without a shared backend, the least recently written go first
+LOCAL_WRITERS_SIZE = 10000
+
+'''
+RoutingSession
+Flask-SQLAlchemy session sending the reads of a request to the replica chosen for it
+    the replica is the bind key stored in g.db_replica by setup_read_replicas
+    flushes and INSERT/UPDATE/DELETE statements always go to the primary
+    a session bound to a connection (the test fixtures) runs everything on that connection
+'''
+class RoutingSession(Session):
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.bind is not None:
+            return self.bind
+        if bind is None and not self._flushing and has_request_context():
+            replica = g.get('db_replica')
+            if replica is not None and not getattr(clause, 'is_dml', False):
+                return self._db.engines[replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+'''
+ReplicaRouter
+Picks the replica serving a read request
+    round_robin: each replica in turn
+    least_connections: the replica with the fewest connections checked out of this worker's pools
+'''
+class ReplicaRouter:
+    def __init__(self, bind_keys, strategy=REPLICA_STRATEGY):
+        if strategy not in ('round_robin', 'least_connections'):
+            raise ValueError("Unknown replica strategy {}".format(strategy))
+        self.bind_keys = list(bind_keys)
+        self.strategy = strategy
+        self._next = itertools.cycle(self.bind_keys)
+        self._lock = threading.Lock()
+
+    def choose(self, engines):
+        if self.strategy == 'least_connections':
+            return min(self.bind_keys, key=lambda key: checked_out(engines[key]))
+        with self._lock:
+            return next(self._next)
+
+def checked_out(engine):
+    checkedout = getattr(engine.pool, 'checkedout', None)
+    return checkedout() if checkedout is not None else 0
+
+'''
+RecentWriters
+Clients that wrote in the last `window` seconds, their reads stay on the primary
+    kept in the response cache's shared backend, so with Redis every worker sees them,
+    a single worker without Redis keeps them in a bounded LRU
+    a client is identified by its Authorization header, or its address without one
+'''
+class RecentWriters:
+    def __init__(self, shared, window=READ_YOUR_WRITES_SECONDS):
+        self.shared = shared
+        self.window = window
+
+    @staticmethod
+    def client_key():
+        client = request.headers.get('Authorization') or request.remote_addr or ''
+        return 'wrote:' + hashlib.sha256(client.encode('utf-8')).hexdigest()
+
+    def mark(self):
+        if self.window > 0:
+            self.shared.set(self.client_key(), 1, ttl=self.window)
+
+    def wrote_recently(self):
+        return self.window > 0 and self.shared.get(self.client_key()) is not None
+
+# True when the current request reads from a replica
+def served_by_replica():
+    return has_request_context() and g.get('db_replica') is not None
+
+'''
+setup_read_replicas(app, bind_keys, strategy, window)
+Routes GET and HEAD requests to one of the replica binds, other requests to the primary
+    a client that wrote in the last `window` seconds reads from the primary,
+    so it sees its own writes despite the replication lag
+    several workers share the recent writers through RESPONSE_CACHE_URL, it is required with more than one
+'''
+def setup_read_replicas(app, bind_keys, strategy=REPLICA_STRATEGY, window=READ_YOUR_WRITES_SECONDS,
+                        workers=WEB_CONCURRENCY):
+    # A write served by one worker must keep the client's reads on the primary in every worker
+    if window > 0 and workers > 1 and not response_cache.is_shared:
+        raise RuntimeError("Read replicas with {} workers need RESPONSE_CACHE_URL, so every worker knows "
+                           "which clients just wrote".format(workers))
+    router = ReplicaRouter(bind_keys, strategy)
+    store = response_cache.shared if response_cache.is_shared else LocalCacheBackend(LOCAL_WRITERS_SIZE)
+    writers = RecentWriters(store, window)
+    app.extensions['read_replicas'] = router
+
+    @app.before_request
+    def choose_read_replica():
+        g.db_replica = None
+        if request.method in READ_METHODS and not writers.wrote_recently():
+            g.db_replica = router.choose(app.extensions['sqlalchemy'].engines)
+
+    @app.after_request
+    def remember_writer(response):
+        if request.method not in READ_METHODS + ('OPTIONS',) and response.status_code < 400:
+            writers.mark()
+        return response
@@ -0,0 +1,20 @@
+# Gunicorn settings, read automatically when gunicorn starts from the project root (see Procfile)
+from settings import SERVING_MODE, WEB_CONCURRENCY, ASYNC_WORKER_CONNECTIONS, DB_POOL_SIZE
+
+workers = WEB_CONCURRENCY
+
+if SERVING_MODE == "async":
+    # gevent workers serve many requests per process, each waiting request costs a greenlet, not a process
+    worker_class = "gevent"
+    worker_connections = ASYNC_WORKER_CONNECTIONS
+    # Requests beyond the pool size wait for a connection, see DB_POOL_SIZE / DB_MAX_OVERFLOW
+    print("Async serving:", workers, "workers x", worker_connections, "connections,",
+          DB_POOL_SIZE, "DB connections per worker")
+else:
+    worker_class = "sync"
+
+
+# Writes the audit events still queued before a worker exits
+def worker_exit(server, worker):
+    from database.audit import audit_log
+    audit_log.close()
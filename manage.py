@@ -1,14 +1,16 @@
-from flask_script import Manager
-from flask_migrate import Migrate, MigrateCommand
+'''
+Management CLI, the Flask CLI of the app (same commands as `flask --app app ...`)
+    python manage.py db upgrade                      # Flask-Migrate migrations
+    python manage.py bootstrap-db
+    python manage.py import movies movies.csv       # or actors, CSV with a header line or .ndjson
+    python manage.py export actors actors.ndjson    # - writes to stdout
+    python manage.py permissions
+'''
+from flask.cli import FlaskGroup
 
-from flaskr import create_app
-from models import db
+from app import create_app
 
-app = create_app()
-migrate = Migrate(app, db)
-manager = Manager(app)
-
-manager.add_command('db', MigrateCommand)
+cli = FlaskGroup(create_app=create_app)
 
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    cli()
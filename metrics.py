@@ -0,0 +1,168 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import Response, g, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+
+# Upper bounds in seconds of the histogram buckets, +Inf is implied
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Phases timed inside a request, reported next to the total
+PHASES = ('auth', 'db', 'json')
+
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+'''
+Histogram
+Bucket counts, sum and count of the observed values, like a Prometheus histogram
+    counts are per bucket and made cumulative when rendered, so observe() is one bisect
+'''
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+'''
+RequestMetrics
+Request duration histograms per route, method and status code, and one per timed phase
+    route is the URL rule (/movie/<int:id>), never the raw path, so label values stay bounded
+    each worker process keeps its own histograms
+'''
+class RequestMetrics:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.durations = {}
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def _observe(self, histograms, labels, value):
+        with self.lock:
+            histogram = histograms.get(labels)
+            if histogram is None:
+                histogram = histograms[labels] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    '''
+    observe(route, method, status, total, phase_times)
+        total is the request duration in seconds, phase_times maps a phase to its seconds
+    '''
+    def observe(self, route, method, status, total, phase_times):
+        labels = (route, method, str(status))
+        self._observe(self.durations, labels, total)
+        for phase in PHASES:
+            self._observe(self.phases, labels + (phase,), phase_times.get(phase, 0.0))
+
+    def clear(self):
+        with self.lock:
+            self.durations.clear()
+            self.phases.clear()
+
+    '''
+    render()
+    Returns the histograms in the Prometheus text exposition format
+    '''
+    def render(self):
+        lines = []
+        with self.lock:
+            self._render(lines, 'http_request_duration_seconds', 'Request duration',
+                         ('route', 'method', 'status'), self.durations)
+            self._render(lines, 'http_request_phase_seconds', 'Time spent per phase of a request',
+                         ('route', 'method', 'status', 'phase'), self.phases)
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render(lines, name, help, label_names, histograms):
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} histogram'.format(name))
+        for labels in sorted(histograms):
+            histogram = histograms[labels]
+            label_text = ','.join('{}="{}"'.format(key, escape_label(value))
+                                  for key, value in zip(label_names, labels))
+            for bound, count in histogram.cumulative():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label_text, le, count))
+            lines.append('{}_sum{{{}}} {}'.format(name, label_text, repr(histogram.sum)))
+            lines.append('{}_count{{{}}} {}'.format(name, label_text, histogram.count))
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+request_metrics = RequestMetrics()
+
+'''
+add_phase_time(phase, seconds)
+Adds seconds to the given phase of the current request, does nothing outside a request
+'''
+def add_phase_time(phase, seconds):
+    if has_request_context() and 'phase_times' in g:
+        g.phase_times[phase] = g.phase_times.get(phase, 0.0) + seconds
+
+'''
+timed_phase(phase)
+Context manager timing its block into the given phase of the current request
+'''
+@contextmanager
+def timed_phase(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase_time(phase, time.perf_counter() - start)
+
+'''
+TimedJSONProvider
+Flask JSON provider timing every dumps() into the json phase, covers jsonify() and app.json.dumps()
+'''
+class TimedJSONProvider(DefaultJSONProvider):
+
+    def dumps(self, obj, **kwargs):
+        with timed_phase('json'):
+            return super().dumps(obj, **kwargs)
+
+'''
+setup_metrics(app, server_timing=False)
+Records the duration of every request and of its auth, db and json phases, and serves them on GET /metrics
+    the db phase is fed by the query profiler installed by setup_db (database/profiling.py)
+    server_timing=True also returns the phases of each request in a Server-Timing header
+'''
+def setup_metrics(app, server_timing=False, metrics=request_metrics):
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+        g.phase_times = {}
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'request_start' not in g:
+            return response
+        total = time.perf_counter() - g.request_start
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe(route, request.method, response.status_code, total, g.phase_times)
+        if server_timing:
+            timings = ['{};dur={:.2f}'.format(phase, g.phase_times[phase] * 1000)
+                       for phase in PHASES if phase in g.phase_times]
+            timings.append('total;dur={:.2f}'.format(total * 1000))
+            response.headers['Server-Timing'] = ', '.join(timings)
+        return response
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        return Response(metrics.render(), content_type=PROMETHEUS_MIMETYPE)
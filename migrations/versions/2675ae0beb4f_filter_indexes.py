@@ -0,0 +1,38 @@
+"""indexes for the list endpoint filters
+
+B-tree indexes for the release_date, age and gender filters, trigram
+GIN indexes for the name prefix and substring searches.
+
+Revision ID: 2675ae0beb4f
+Revises: b38439e2e0ed
+Create Date: 2026-10-18 10:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2675ae0beb4f'
+down_revision = 'b38439e2e0ed'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_movies_release_date', 'movies', ['release_date'])
+    op.create_index('ix_movies_name_trgm', 'movies', ['name'],
+                    postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('ix_actors_age', 'actors', ['age'])
+    op.create_index('ix_actors_gender_age', 'actors', ['gender', 'age'])
+    op.create_index('ix_actors_name_trgm', 'actors', ['name'],
+                    postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_actors_name_trgm', table_name='actors')
+    op.drop_index('ix_actors_gender_age', table_name='actors')
+    op.drop_index('ix_actors_age', table_name='actors')
+    op.drop_index('ix_movies_name_trgm', table_name='movies')
+    op.drop_index('ix_movies_release_date', table_name='movies')
@@ -0,0 +1,39 @@
+"""audit log of the writes to movies and actors
+
+Filled in batches by the write-behind audit log (database/audit.py).
+
+Revision ID: 5e0b2a7d3c18
+Revises: c7d1f0a94e21
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '5e0b2a7d3c18'
+down_revision = 'c7d1f0a94e21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'audit_log',
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('action', sa.String(length=10), nullable=False),
+        sa.Column('table_name', sa.String(), nullable=False),
+        sa.Column('row_id', sa.Integer(), nullable=True),
+        sa.Column('actor', sa.String(), nullable=True),
+        sa.Column('data', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_audit_log_table_name_row_id', 'audit_log', ['table_name', 'row_id'])
+
+
+def downgrade():
+    op.drop_index('ix_audit_log_table_name_row_id', table_name='audit_log')
+    op.drop_table('audit_log')
@@ -0,0 +1,29 @@
+"""row versions for optimistic concurrency
+
+A version column on movies and actors, bumped by every UPDATE and
+checked against If-Match by the PATCH endpoints.
+
+Revision ID: c7d1f0a94e21
+Revises: 2675ae0beb4f
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d1f0a94e21'
+down_revision = '2675ae0beb4f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('movies', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('actors', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('actors', 'version')
+    op.drop_column('movies', 'version')
@@ -18,3 +18,87 @@ EXECUTIVE_PRODUCER_TOKEN = os.environ.get("EXECUTIVE_PRODUCER_TOKEN")
 AUTH0_DOMAIN = os.environ.get("AUTH0_DOMAIN")
 API_AUDIENCE = os.environ.get("API_AUDIENCE")
 ALGORITHMS = os.environ.get("ALGORITHMS")
+
+# Keyset pagination for the list endpoints
+DEFAULT_PAGE_SIZE = int(os.environ.get("DEFAULT_PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 1000))
+
+# Rows fetched per round trip by the streaming NDJSON export
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 1000))
+# Chunks of the import and export commands: bytes of a CSV file sent to COPY at a time,
+# and rows of an NDJSON file converted or fetched at a time
+COPY_CHUNK_BYTES = int(os.environ.get("COPY_CHUNK_BYTES", 1024 * 1024))
+COPY_CHUNK_ROWS = int(os.environ.get("COPY_CHUNK_ROWS", 10000))
+
+# Maximum number of items accepted by one bulk request
+BULK_MAX_ITEMS = int(os.environ.get("BULK_MAX_ITEMS", 1000))
+
+# Response cache for the list endpoints, 0 disables it
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 256))
+# Seconds a body stays in a worker's cache, the longest a worker that missed a write serves it without RESPONSE_CACHE_URL
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 30))
+# Optional redis:// URL shared by all workers for the collection versions
+RESPONSE_CACHE_URL = os.environ.get("RESPONSE_CACHE_URL")
+
+# Database connection pool, per worker process
+# With DB_MAX_CONNECTIONS set, it is split evenly across the WEB_CONCURRENCY gunicorn workers
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", 1))
+DB_MAX_CONNECTIONS = os.environ.get("DB_MAX_CONNECTIONS")
+if DB_MAX_CONNECTIONS is not None:
+    DB_POOL_SIZE = max(1, int(DB_MAX_CONNECTIONS) // WEB_CONCURRENCY)
+    DB_MAX_OVERFLOW = 0
+else:
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+    DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+# How gunicorn serves requests (gunicorn.conf.py)
+# "sync": one request at a time per worker, "async": gevent workers, many concurrent requests per worker
+SERVING_MODE = os.environ.get("SERVING_MODE", "sync")
+if SERVING_MODE not in ("sync", "async"):
+    raise ValueError("SERVING_MODE must be sync or async, got {}".format(SERVING_MODE))
+# Concurrent requests per async worker
+ASYNC_WORKER_CONNECTIONS = int(os.environ.get("ASYNC_WORKER_CONNECTIONS", 1000))
+
+# Per-request timing histograms served on GET /metrics, "false" turns them off
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+# Also return the auth, db and json timings of each request in a Server-Timing header
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+
+# SQL statements slower than this are printed with their parameters and EXPLAIN plan, 0 disables the log
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 500))
+# Return the number of SQL statements run by each request in an X-Query-Count header (always on in debug)
+QUERY_COUNT_HEADER = os.environ.get("QUERY_COUNT_HEADER", "false").lower() in ("1", "true", "yes")
+
+# Optional read replicas of the database, comma separated URLs, GET requests read from them
+DATABASE_REPLICA_URLS = [url.strip() for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+# How each GET request picks its replica: round_robin or least_connections
+REPLICA_STRATEGY = os.environ.get("REPLICA_STRATEGY", "round_robin")
+if REPLICA_STRATEGY not in ("round_robin", "least_connections"):
+    raise ValueError("REPLICA_STRATEGY must be round_robin or least_connections, got {}".format(REPLICA_STRATEGY))
+# Seconds a client reads from the primary after a write, so it sees its own writes despite the replication lag
+READ_YOUR_WRITES_SECONDS = float(os.environ.get("READ_YOUR_WRITES_SECONDS", 5))
+
+# Audit trail of every create, update and delete of movies and actors, written behind the request
+# "database" (audit_log table), "file" (JSON lines appended to AUDIT_LOG_PATH) or "off"
+AUDIT_LOG = os.environ.get("AUDIT_LOG", "database")
+if AUDIT_LOG not in ("database", "file", "off"):
+    raise ValueError("AUDIT_LOG must be database, file or off, got {}".format(AUDIT_LOG))
+AUDIT_LOG_PATH = os.environ.get("AUDIT_LOG_PATH", "audit.log")
+# Writes buffered in memory (a bulk write is one), when full a write waits up to AUDIT_BLOCK_TIMEOUT seconds before dropping its events
+AUDIT_QUEUE_SIZE = int(os.environ.get("AUDIT_QUEUE_SIZE", 10000))
+AUDIT_BLOCK_TIMEOUT = float(os.environ.get("AUDIT_BLOCK_TIMEOUT", 0.1))
+# Events per batched insert, and the longest an event waits for its batch to be written
+AUDIT_BATCH_SIZE = int(os.environ.get("AUDIT_BATCH_SIZE", 500))
+AUDIT_FLUSH_INTERVAL = float(os.environ.get("AUDIT_FLUSH_INTERVAL", 1.0))
+# Writes of a batch tried before it is dropped, retried every AUDIT_FLUSH_INTERVAL seconds
+AUDIT_MAX_ATTEMPTS = int(os.environ.get("AUDIT_MAX_ATTEMPTS", 5))
+
+# Seconds the response of a POST sent with an Idempotency-Key is replayed to retries of the same key
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", 24 * 3600))
+# Seconds a retry waits for the response of the request still holding its key, before answering 409
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get("IDEMPOTENCY_WAIT_SECONDS", 5))
+# Keys (and their responses) kept by each worker without RESPONSE_CACHE_URL, the least recently used go first
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 1000))
@@ -1,31 +1,99 @@
+import io
 import os
 import json
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 from ast import Pass
 from datetime import datetime
+from flask import Flask, g, jsonify, request
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy import exc as sqlalchemy_exc
+from sqlalchemy_utils import database_exists, create_database
+# The tests drop and create tables, they always run on the database of .env_test
+os.environ.setdefault("FLASK_ENV", "test")
 from settings import DB_NAME, DB_USER, DB_PASSWORD, DB_HOST
-from database.models import db, setup_db, create_tables_for_test, Movie, Actor
-from app import create_app
+from database.models import db, setup_db, create_tables_for_test, bulk_update, bulk_delete, Movie, Actor
+from database.cache import ResponseCache, LocalCacheBackend, DictSharedBackend, response_cache
+from database.replicas import ReplicaRouter, setup_read_replicas
+from database.pool import InstrumentedQueuePool
+from database.profiling import QueryProfiler, SAVEPOINT_STATEMENTS
+from database.bulk_copy import CopyProgress, load_rows, dump_rows
+from database.audit import AuditLog, FileAuditSink, audit_log
+from database.idempotency import IdempotencyStore
+from auth.auth import AuthError, JWKSCache, VerifiedTokenCache, RequiredPermissions, check_permissions, \
+    parse_algorithms, requires_auth, route_permissions, token_permissions, use_key_source, verify_decode_jwt, \
+    AUTH0_DOMAIN, API_AUDIENCE
+from auth.local_issuer import LocalTokenIssuer
+from metrics import RequestMetrics, setup_metrics
+from serialization import json_response
+from app import create_app, get_movie_filters, get_actor_filters, idempotent
 
-CASTING_ASSISTANT_TOKEN = os.getenv('CASTING_ASSISTANT_TOKEN')
-CASTING_DIRECTOR_TOKEN = os.getenv('CASTING_DIRECTOR_TOKEN')
-EXECUTIVE_PRODUCER_TOKEN = os.getenv('EXECUTIVE_PRODUCER_TOKEN')
+# Role tokens minted by a local issuer, the tests need neither Auth0 nor the network
+token_issuer = LocalTokenIssuer(AUTH0_DOMAIN, API_AUDIENCE, key_size=1024)
+use_key_source(token_issuer.jwks)
+CASTING_ASSISTANT_TOKEN = token_issuer.mint_role('casting_assistant')
+CASTING_DIRECTOR_TOKEN = token_issuer.mint_role('casting_director')
+EXECUTIVE_PRODUCER_TOKEN = token_issuer.mint_role('executive_producer')
 
-# Actors Testing Class 
-class ActorsTestCase(unittest.TestCase):
-    print("This class includes test cases for Actors API endpoints")
+# Test database, DB_NAME of .env_test when FLASK_ENV=test
+TEST_DATABASE_URI = 'postgresql://{}:{}@{}/{}'.format(DB_USER, DB_PASSWORD, DB_HOST, DB_NAME)
+
+'''
+DatabaseTestCase
+Base class of the test cases that go through the app and the database
+    the app and the schema are created once per run, not once per test
+    each test runs inside a transaction of one connection, rolled back in tearDown,
+    the commits of the app only release a SAVEPOINT (join_transaction_mode="create_savepoint")
+'''
+class DatabaseTestCase(unittest.TestCase):
+    app = None
+
+    @classmethod
+    def setUpClass(cls):
+        if DatabaseTestCase.app is None:
+            DatabaseTestCase.app = create_app(TEST_DATABASE_URI)
+            with DatabaseTestCase.app.app_context():
+                create_tables_for_test()
+        # The audit sink writes on its own connection, outside the test transaction
+        audit_log.configure(None)
 
     def setUp(self):
         self.assistant = CASTING_ASSISTANT_TOKEN
         self.director = CASTING_DIRECTOR_TOKEN
         self.producer = EXECUTIVE_PRODUCER_TOKEN
-
-        self.app = create_app()
+        self.app.config["QUERY_COUNT_HEADER"] = False
         self.client = self.app.test_client()
-        setup_db(self.app)
-        with self.app.app_context():
-            create_tables_for_test()
+        self.context = self.app.app_context()
+        self.context.push()
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        db.session.remove()
+        db.session.configure(bind=self.connection, join_transaction_mode="create_savepoint")
+
+    def tearDown(self):
+        db.session.remove()
+        db.session.configure(bind=None, join_transaction_mode="conditional_savepoint")
+        self.transaction.rollback()
+        self.connection.close()
+        self.context.pop()
+        # Bodies cached during the test hold rows that were just rolled back
+        for collection in ('movies', 'actors'):
+            response_cache.bump(collection)
+
+# Closes the connections of the shared test app once every test has run
+def tearDownModule():
+    if DatabaseTestCase.app is not None:
+        with DatabaseTestCase.app.app_context():
+            for engine in db.engines.values():
+                engine.dispose()
+
+# Actors Testing Class 
+class ActorsTestCase(DatabaseTestCase):
+    print("This class includes test cases for Actors API endpoints")
 
     # Get all Actors Test Case 
     def test_get_all_actors_postitive(self):
@@ -36,13 +104,34 @@ class ActorsTestCase(unittest.TestCase):
         self.assertTrue(data['success'], "Success attribute of response json = False")
         self.assertGreaterEqual(len(data['actors']), 1, "No Actors returned")
 
+    # Get Actors page with projection Test Case
+    def test_get_actors_paginated(self):
+        for name in ["Page One", "Page Two", "Page Three"]:
+            self.client.post("/actor", headers={"Authorization": "Bearer {}".format(self.producer)}, json={"name": name, "age": 30, "gender": "F"})
+        res = self.client.get("/actors?limit=2&fields=name", headers={"Authorization": "Bearer {}".format(self.producer)})
+        data = json.loads(res.data)
+        self.assertTrue(data['success'], "Success attribute of response json = False")
+        self.assertEqual(len(data['actors']), 2, "Page size not applied")
+        self.assertEqual(set(data['actors'][0]), {"id", "name"}, "Projection not applied")
+        res = self.client.get("/actors?limit=2&after_id={}".format(data['next_cursor']), headers={"Authorization": "Bearer {}".format(self.producer)})
+        data = json.loads(res.data)
+        self.assertEqual(len(data['actors']), 1, "Second page not returned")
+        self.assertIsNone(data['next_cursor'], "Last page returned a cursor")
+
+    # Get Actors with filters the database can't take Test Case
+    def test_get_actors_invalid_filters(self):
+        for url in ["/actors?min_age=99999999999", "/actors?max_age=-99999999999", "/actors?name=%00",
+                    "/actors?name_prefix=a%00", "/actors?gender=%00", "/movies?name=%00"]:
+            res = self.client.get(url, headers={"Authorization": "Bearer {}".format(self.producer)})
+            self.assertEqual(res.status_code, 400, "{} not refused with 400".format(url))
+
     # Post an Actor Test Case
     def test_post_an_actor_positive(self):
         test_actor = {"name": "Salman", "age": 62, "gender": "M"}
         res = self.client.post("/actor", headers={"Authorization": "Bearer {}".format(self.producer)}, json=test_actor)
         data = json.loads(res.data)
         self.assertTrue(data['success'], "Success attribute of response json = False")
-        id = Actor.query.get(data['actor']['id'])
+        id = db.session.get(Actor, data['actor']['id'])
         test_actor["id"] = data['actor']['id']
         self.assertEqual(id.serialized_actor(), test_actor, "Actor in test case and the actor posted in DB are not same")
 
@@ -61,6 +150,89 @@ class ActorsTestCase(unittest.TestCase):
         test_actor["id"] = id
         self.assertEqual(data["actor"], test_actor, "Actor in test case and the actor posted in DB are not same")
 
+    # Query budget of PATCH /actor/<id>: a single UPDATE ... RETURNING
+    def test_patch_an_actor_query_budget(self):
+        self.app.config["QUERY_COUNT_HEADER"] = True
+        res = self.client.post("/actor", headers={"Authorization": "Bearer {}".format(self.producer)}, json={"name": "Budget", "age": 40, "gender": "F"})
+        id = json.loads(res.data)['actor']['id']
+        res = self.client.patch(f'/actor/{id}', json={"age": 41}, headers={"Authorization": "Bearer {}".format(self.producer)})
+        self.assertLessEqual(int(res.headers["X-Query-Count"]), 1, "PATCH /actor/<id> exceeded its query budget")
+
+    # Lost update of an Actor Test Case, the second writer with a stale If-Match gets 412
+    def test_patch_an_actor_stale_if_match(self):
+        res = self.client.post("/actor", headers={"Authorization": "Bearer {}".format(self.producer)}, json={"name": "Versioned", "age": 30, "gender": "M"})
+        id = json.loads(res.data)['actor']['id']
+        etag = res.headers["ETag"]
+        res = self.client.patch(f'/actor/{id}', json={"age": 31}, headers={"Authorization": "Bearer {}".format(self.director), "If-Match": etag})
+        self.assertEqual(res.status_code, 200, "Update with the current version failed")
+        self.assertNotEqual(res.headers["ETag"], etag, "Version not bumped by the update")
+        res = self.client.patch(f'/actor/{id}', json={"age": 32}, headers={"Authorization": "Bearer {}".format(self.producer), "If-Match": etag})
+        self.assertEqual(res.status_code, 412, "Update with a stale version was applied")
+
+    # Bulk create Actors with one invalid item Test Case
+    def test_post_actors_bulk(self):
+        test_actors = [{"name": "Bulk One", "age": 40, "gender": "M"}, {"name": "Bulk Two"}, {"name": "Bulk Three", "age": 41, "gender": "F"}]
+        res = self.client.post("/actors/bulk", headers={"Authorization": "Bearer {}".format(self.producer)}, json=test_actors)
+        data = json.loads(res.data)
+        self.assertTrue(data['success'], "Success attribute of response json = False")
+        self.assertEqual([actor['name'] for actor in data['actors']], ["Bulk One", "Bulk Three"], "Valid actors not inserted")
+        self.assertEqual([error['index'] for error in data['errors']], [1], "Invalid actor not reported")
+
+    # Bulk create Actors with fields of the wrong JSON type Test Case
+    def test_post_actors_bulk_wrong_types(self):
+        test_actors = [{"name": "Bulk Float", "age": 40.7, "gender": "M"}, {"name": 123, "age": 40, "gender": "M"},
+                       {"name": "Bulk Bool", "age": True, "gender": "F"}, {"name": "Bulk Six", "age": 40, "gender": "F"}]
+        res = self.client.post("/actors/bulk", headers={"Authorization": "Bearer {}".format(self.producer)}, json=test_actors)
+        data = json.loads(res.data)
+        self.assertEqual([actor['name'] for actor in data['actors']], ["Bulk Six"], "Mistyped actors were coerced")
+        self.assertEqual([(error['index'], error['error']) for error in data['errors']], [(0, 422), (1, 422), (2, 422)],
+                         "Mistyped actors not reported as 422")
+
+    # Bulk delete Actors with ids that are not row ids Test Case
+    def test_delete_actors_bulk_invalid_ids(self):
+        res = self.client.post("/actor", headers={"Authorization": "Bearer {}".format(self.producer)}, json={"name": "Bulk Seven", "age": 40, "gender": "F"})
+        id = json.loads(res.data)['actor']['id']
+        res = self.client.delete("/actors/bulk", headers={"Authorization": "Bearer {}".format(self.producer)}, json=[True, 2 ** 40, "1", id])
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(res.data)
+        self.assertEqual(data['deleted'], [id], "Valid id not deleted")
+        self.assertEqual([(error['index'], error['error']) for error in data['errors']], [(0, 400), (1, 400), (2, 400)],
+                         "Invalid ids not reported as 400")
+
+    # Bulk update Actors with an id out of range Test Case
+    def test_patch_actors_bulk_invalid_id(self):
+        res = self.client.patch("/actors/bulk", headers={"Authorization": "Bearer {}".format(self.producer)},
+                                json=[{"id": 2 ** 40, "age": 50}, {"id": True, "age": 50}])
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(res.data)
+        self.assertEqual(data['updated'], [])
+        self.assertEqual([(error['index'], error['error']) for error in data['errors']], [(0, 400), (1, 400)],
+                         "Invalid ids not reported as 400")
+
+    # A database error of a bulk statement becomes a per-item 422, not a 500
+    def test_bulk_statement_errors_are_per_item(self):
+        res = self.client.post("/actor", headers={"Authorization": "Bearer {}".format(self.producer)}, json={"name": "Bulk Eight", "age": 40, "gender": "F"})
+        id = json.loads(res.data)['actor']['id']
+        with self.app.test_request_context():
+            updated, errors = bulk_update(Actor, [(0, {"id": 2 ** 40, "age": 50}), (1, {"id": id, "age": 50})])
+            self.assertEqual((updated, [error['error'] for error in errors]), ([], [422, 422]))
+            deleted, errors = bulk_delete(Actor, [(0, 2 ** 40), (1, id), (2, 999999)])
+        self.assertEqual(deleted, [id], "Valid id not deleted after the batch DELETE failed")
+        self.assertEqual([(error['index'], error['error']) for error in errors], [(0, 422), (2, 404)])
+
+    # Bulk update and delete Actors Test Case
+    def test_patch_and_delete_actors_bulk(self):
+        test_actors = [{"name": "Bulk Four", "age": 40, "gender": "M"}, {"name": "Bulk Five", "age": 41, "gender": "F"}]
+        res = self.client.post("/actors/bulk", headers={"Authorization": "Bearer {}".format(self.producer)}, json=test_actors)
+        ids = [actor['id'] for actor in json.loads(res.data)['actors']]
+        res = self.client.patch("/actors/bulk", headers={"Authorization": "Bearer {}".format(self.producer)}, json=[{"id": id, "age": 50} for id in ids])
+        self.assertEqual(json.loads(res.data)['updated'], ids, "Actors not updated")
+        self.assertEqual(db.session.get(Actor, ids[0]).age, 50, "Updated age not stored")
+        res = self.client.delete("/actors/bulk", headers={"Authorization": "Bearer {}".format(self.producer)}, json=ids + [999999])
+        data = json.loads(res.data)
+        self.assertEqual(data['deleted'], ids, "Actors not deleted")
+        self.assertEqual([error['error'] for error in data['errors']], [404], "Unknown id not reported")
+
     # # Update Test Case for Actor - Negative #
     # def test_patch_an_actor_negative(self):
     #     id = 999
@@ -90,42 +262,86 @@ class ActorsTestCase(unittest.TestCase):
 
 # Movies Class Rest Cases 
 
-class MoviesTestCase(unittest.TestCase):
+class MoviesTestCase(DatabaseTestCase):
     print("This class includes test cases for Movies API endpoints")
 
-    def setUp(self):
-        self.assistant = CASTING_ASSISTANT_TOKEN
-        self.director = CASTING_DIRECTOR_TOKEN
-        self.producer = EXECUTIVE_PRODUCER_TOKEN
-        self.db_path = 'postgresql://{}:{}@{}/{}'.format(DB_USER, DB_PASSWORD, DB_HOST, DB_NAME)
-
-        self.app = create_app(self.db_path)
-        self.client = self.app.test_client()
-        # setup_db(self.app)
-        self.app.app_context().push()
-
-    def tearDown(self):
-        db.session.close()
-
     # Get all Movies Test Case - positive
     def test_get_all_movies_postitive(self):
         test_movie = {"name": "Dear Zindagi", "release_date": "2018-06-04"}
-        res = self.client.post("/movies", headers={"Authorization": "Bearer {}".format(self.producer)}, json=test_movie)
+        res = self.client.post("/movie", headers={"Authorization": "Bearer {}".format(self.producer)}, json=test_movie)
         res = self.client.get("/movies", headers={"Authorization": "Bearer {}".format(self.producer)})
         data = json.loads(res.data)
         self.assertTrue(data['success'], "Success attribute of response json = False")
         self.assertGreaterEqual(len(data['movies']), 1, "No Movies returned")
 
+    # Query budget of GET /movies: one SELECT whatever the number of movies
+    def test_get_all_movies_query_budget(self):
+        self.app.config["QUERY_COUNT_HEADER"] = True
+        for name in ["Budget One", "Budget Two"]:
+            self.client.post("/movie", headers={"Authorization": "Bearer {}".format(self.producer)}, json={"name": name, "release_date": "2021-01-01"})
+        res = self.client.get("/movies", headers={"Authorization": "Bearer {}".format(self.producer)})
+        self.assertLessEqual(int(res.headers["X-Query-Count"]), 1, "GET /movies exceeded its query budget")
+
+    # Export Movies as NDJSON Test Case
+    def test_export_movies_ndjson(self):
+        test_movie = {"name": "Export Me", "release_date": "2019-03-01"}
+        self.client.post("/movie", headers={"Authorization": "Bearer {}".format(self.producer)}, json=test_movie)
+        res = self.client.get("/movies", headers={"Authorization": "Bearer {}".format(self.producer), "Accept": "application/x-ndjson"})
+        self.assertEqual(res.mimetype, "application/x-ndjson", "NDJSON was not returned")
+        exported = [json.loads(line) for line in res.data.decode().splitlines()]
+        listed = json.loads(self.client.get("/movies", headers={"Authorization": "Bearer {}".format(self.producer)}).data)['movies']
+        self.assertEqual(exported, listed, "Exported movies differ from GET /movies")
+
+    # Conditional GET for Movies Test Case
+    def test_get_movies_etag(self):
+        self.client.post("/movie", headers={"Authorization": "Bearer {}".format(self.producer)}, json={"name": "Cached", "release_date": "2020-01-01"})
+        res = self.client.get("/movies", headers={"Authorization": "Bearer {}".format(self.producer)})
+        etag = res.headers['ETag']
+        res = self.client.get("/movies", headers={"Authorization": "Bearer {}".format(self.producer), "If-None-Match": etag})
+        self.assertEqual(res.status_code, 304, "Unchanged collection not answered with 304")
+        self.client.post("/movie", headers={"Authorization": "Bearer {}".format(self.producer)}, json={"name": "Cached 2", "release_date": "2020-01-02"})
+        res = self.client.get("/movies", headers={"Authorization": "Bearer {}".format(self.producer), "If-None-Match": etag})
+        self.assertEqual(res.status_code, 200, "Stale ETag answered with 304 after a write")
+        self.assertIn("Cached 2", [movie['name'] for movie in json.loads(res.data)['movies']], "Cached response served after a write")
+
+    # Get Movies with an unknown projection field - Negative
+    def test_get_movies_unknown_field(self):
+        res = self.client.get("/movies?fields=budget", headers={"Authorization": "Bearer {}".format(self.producer)})
+        data = json.loads(res.data)
+        self.assertFalse(data['success'], "success attribute in response json was true")
+        self.assertEqual(int(data['error']), 400, "error code is not 400")
+
+    # Get Movies after an id beyond the id column Test Case
+    def test_get_movies_after_id_out_of_range(self):
+        res = self.client.get("/movies?after_id=99999999999999", headers={"Authorization": "Bearer {}".format(self.producer)})
+        data = json.loads(res.data)
+        self.assertFalse(data['success'], "success attribute in response json was true")
+        self.assertEqual(int(data['error']), 400, "error code is not 400")
+
     # Post a Movie Test Case
     def test_post_an_movie_positive(self):
         test_movie = {"name": "Shehjada", "release_date": "2022-10-08"}
         res = self.client.post("/movie", headers={"Authorization": "Bearer {}".format(self.producer)}, json=test_movie)
         data = json.loads(res.data)
         self.assertTrue(data['success'], "Success attribute of response json = False")
-        id = Movie.query.get(data['movie']['id'])
+        id = db.session.get(Movie, data['movie']['id'])
         test_movie["id"] = data['movie']['id']
         self.assertEqual(id.serialized_movie(), test_movie, "Movie in test case and the movie posted in DB are not same")
 
+    # Retried Movie POST with an Idempotency-Key Test Case, replayed without touching the movies table
+    def test_post_an_movie_idempotency_key(self):
+        self.app.config["QUERY_COUNT_HEADER"] = True
+        headers = {"Authorization": "Bearer {}".format(self.producer), "Idempotency-Key": "retry-movie-1"}
+        test_movie = {"name": "Retried", "release_date": "2022-10-08"}
+        res = self.client.post("/movie", headers=headers, json=test_movie)
+        retry = self.client.post("/movie", headers=headers, json=test_movie)
+        self.assertEqual(retry.get_json(), res.get_json(), "Retry did not return the original response")
+        self.assertEqual(retry.headers["ETag"], res.headers["ETag"], "Retry did not return the original ETag")
+        self.assertEqual(retry.headers["X-Query-Count"], "0", "Retry ran queries")
+        self.assertEqual(Movie.query.filter_by(name="Retried").count(), 1, "Retry inserted a duplicate movie")
+        res = self.client.post("/movie", headers=headers, json={"name": "Other", "release_date": "2022-10-08"})
+        self.assertEqual(res.status_code, 422, "Idempotency-Key reused with another body was accepted")
+
     # Update an Movie Test Case
     def test_patch_an_movie(self):
         test_movie = {"name": "Badmaash Company", "release_date": "2008-12-01"}
@@ -140,6 +356,15 @@ class MoviesTestCase(unittest.TestCase):
         test_movie["id"] = id
         self.assertEqual(data["movie"], test_movie, "Movie in test case and the movie posted in DB are not same")
 
+    # Update a Movie without any known field Test Case, nothing changes
+    def test_patch_an_movie_without_fields(self):
+        res = self.client.post("/movie", headers={"Authorization": "Bearer {}".format(self.producer)}, json={"name": "Unchanged", "release_date": "2001-01-01"})
+        id, etag = json.loads(res.data)['movie']['id'], res.headers["ETag"]
+        res = self.client.patch(f'/movie/{id}', json={"budget": 10}, headers={"Authorization": "Bearer {}".format(self.producer), "If-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers["ETag"], etag, "Version bumped by an update that changed nothing")
+        self.assertEqual(json.loads(res.data)["movie"]["name"], "Unchanged")
+
     # # Update Test Case for Movie - Negative #
     # def test_patch_an_movie_negative(self):
     #     id = 999
@@ -159,6 +384,16 @@ class MoviesTestCase(unittest.TestCase):
         self.assertTrue(data['success'], "success attribute in response json was false")
         self.assertEqual(data['id'], id, "Movie inserted hasn't been deleted")
 
+    # Query budget of DELETE /movie/<id>: a single DELETE ... RETURNING, also when the movie is gone
+    def test_delete_an_movie_query_budget(self):
+        self.app.config["QUERY_COUNT_HEADER"] = True
+        res = self.client.post("/movie", json={"name": "Budget Delete", "release_date": "2007-01-01"}, headers={"Authorization": "Bearer {}".format(self.producer)})
+        id = json.loads(res.data)['movie']['id']
+        for status in (200, 404):
+            res = self.client.delete(f'/movie/{id}', headers={"Authorization": "Bearer {}".format(self.producer)})
+            self.assertEqual(res.status_code, status)
+            self.assertEqual(res.headers["X-Query-Count"], "1", "DELETE /movie/<id> exceeded its query budget")
+
 #     # Delete Test Case for Movie - Negative
 #     def test_delete_an_movie_negative(self):
 #         id = 999
@@ -168,26 +403,13 @@ class MoviesTestCase(unittest.TestCase):
 #         self.assertEqual(int(data['error']), 404, "error code is not 404")
 
 # Auth Test Cases for Casting Assistant, Director and Producer 
-class AuthTestCase(unittest.TestCase):
+class AuthTestCase(DatabaseTestCase):
     print("This class include testcases for the different level of RBAC access")
 
-    def setUp(self):
-        self.assistant = CASTING_ASSISTANT_TOKEN
-        self.director = CASTING_DIRECTOR_TOKEN
-        self.producer = EXECUTIVE_PRODUCER_TOKEN
-        self.db_path = 'postgresql://{}:{}@{}/{}'.format(DB_USER, DB_PASSWORD, DB_HOST, DB_NAME)
-
-        self.app = create_app(self.db_path)
-        self.client = self.app.test_client()
-        self.app.app_context().push()
-
-    def tearDown(self):
-        db.session.close()
-
     # Authorization Test Cases for Casting Assisstant
     def test_get_all_movies_casting_assistant(self):
         test_movie = {"name": "Singh is King", "release_date": "2014-05-06"}
-        res = self.client.post("/movies", json=test_movie, headers={"Authorization": "Bearer {}".format(self.producer)})
+        res = self.client.post("/movie", json=test_movie, headers={"Authorization": "Bearer {}".format(self.producer)})
         res = self.client.get("/movies", headers={"Authorization": "Bearer {}".format(self.assistant)})
         data = json.loads(res.data)
         self.assertTrue(data['success'], "Success attribute of response json = False")
@@ -195,7 +417,7 @@ class AuthTestCase(unittest.TestCase):
 
     def test_get_all_actors_casting_assistant(self):
         test_actor = {"name": "Ajay Devgan", "age": "56", "gender": "M"}
-        res = self.client.post("/actors", json=test_actor, headers={"Authorization": "Bearer {}".format(self.producer)})
+        res = self.client.post("/actor", json=test_actor, headers={"Authorization": "Bearer {}".format(self.producer)})
         res = self.client.get("/actors", headers={"Authorization": "Bearer {}".format(self.assistant)})
         data = json.loads(res.data)
         self.assertTrue(data['success'], "Success attribute of response json = False")
@@ -223,7 +445,7 @@ class AuthTestCase(unittest.TestCase):
         res = self.client.post("/actor", json=test_actor, headers={"Authorization": "Bearer {}".format(self.director)})
         data = json.loads(res.data)
         self.assertTrue(data['success'], "success attribute in response json was false")
-        id = Actor.query.get(data['actor']['id'])
+        id = db.session.get(Actor, data['actor']['id'])
         test_actor["id"] = data['actor']['id']
         self.assertEqual(id.serialized_actor(), test_actor, "Actor in test case and the Actor posted in DB are not same")
 
@@ -251,7 +473,7 @@ class AuthTestCase(unittest.TestCase):
         res = self.client.post("/movie", json=test_movie, headers={"Authorization": "Bearer {}".format(self.producer)})
         data = json.loads(res.data)
         self.assertTrue(data['success'], "success attribute in response json was false")
-        id = Movie.query.get(data['movie']['id'])
+        id = db.session.get(Movie, data['movie']['id'])
         test_movie["id"] = data['movie']['id']
         self.assertEqual(id.serialized_movie(), test_movie, "Movie in test case and the Movie posted in DB are not same")
 
@@ -260,7 +482,7 @@ class AuthTestCase(unittest.TestCase):
         res = self.client.post("/actor", json=test_actor, headers={"Authorization": "Bearer {}".format(self.producer)})
         data = json.loads(res.data)
         self.assertTrue(data['success'], "success attribute in response json was false")
-        id = Actor.query.get(data['actor']['id'])
+        id = db.session.get(Actor, data['actor']['id'])
         test_actor["id"] = data['actor']['id']
         self.assertEqual(id.serialized_actor(), test_actor, "Actor in test case and the Actor posted in DB are not same")
 
@@ -282,5 +504,618 @@ class AuthTestCase(unittest.TestCase):
         self.assertTrue(data['success'], "success attribute in response json was false")
         self.assertEqual(data['id'], id, "Actor inserted hasn't been deleted")
 
+# Catalogue COPY import and export Test Cases, inside the test transaction
+class CatalogueCopyTestCase(DatabaseTestCase):
+
+    def test_csv_import_then_ndjson_export(self):
+        file = io.BytesIO(b'name,release_date\n"Padosan, the ""remake""",1968-01-01\nSholay,1975-08-15\n')
+        self.assertEqual(load_rows(self.connection, Movie, file, 'csv', CopyProgress('test')), 2)
+        output = io.BytesIO()
+        self.assertEqual(dump_rows(self.connection, Movie, output, 'ndjson', CopyProgress('test')), 2)
+        movies = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([(movie['name'], movie['release_date']) for movie in movies],
+                         [('Padosan, the "remake"', '1968-01-01'), ('Sholay', '1975-08-15')])
+
+    def test_ndjson_import_with_ids_moves_the_sequence(self):
+        file = io.BytesIO(b'{"id": 900001, "name": "Imported", "age": 40, "gender": "F"}\n\n'
+                          b'{"id": 900002, "name": "Imported Too", "age": 41, "gender": "M"}\n')
+        self.assertEqual(load_rows(self.connection, Actor, file, 'ndjson', CopyProgress('test')), 2)
+        output = io.BytesIO()
+        dump_rows(self.connection, Actor, output, 'csv', CopyProgress('test'))
+        self.assertEqual(output.getvalue().splitlines()[0], b'id,name,age,gender')
+        res = self.client.post("/actor", headers={"Authorization": "Bearer {}".format(self.producer)}, json={"name": "After", "age": 30, "gender": "F"})
+        self.assertEqual(json.loads(res.data)['actor']['id'], 900003, "Id sequence not moved past the imported ids")
+
+    def test_unknown_column_is_refused(self):
+        with self.assertRaises(ValueError):
+            load_rows(self.connection, Movie, io.BytesIO(b'name,budget\nX,1\n'), 'csv', CopyProgress('test'))
+
+# Counts the SQL statements run on the engine inside a with block
+# The SAVEPOINTs of the test transaction are left out, like the query profiler does
+class QueryCounter:
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, conn, cursor, statement, *args):
+        if not statement.startswith(SAVEPOINT_STATEMENTS):
+            self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+# Casting Test Cases, including query budgets so N+1 regressions fail
+class CastingTestCase(DatabaseTestCase):
+
+    def cast_new_movie(self, actors):
+        headers = {"Authorization": "Bearer {}".format(self.producer)}
+        res = self.client.post("/movie", headers=headers, json={"name": "Cast Movie", "release_date": "2021-01-01"})
+        movie_id = json.loads(res.data)['movie']['id']
+        for i in range(actors):
+            res = self.client.post("/actor", headers=headers, json={"name": "Cast {}".format(i), "age": 30, "gender": "F"})
+            self.client.post(f'/movie/{movie_id}/actors', headers=headers, json={"actor_id": json.loads(res.data)['actor']['id']})
+        return movie_id
+
+    def test_get_movie_actors(self):
+        movie_id = self.cast_new_movie(3)
+        with QueryCounter(db.engine) as queries:
+            res = self.client.get(f'/movie/{movie_id}/actors', headers={"Authorization": "Bearer {}".format(self.producer)})
+        data = json.loads(res.data)
+        self.assertTrue(data['success'], "Success attribute of response json = False")
+        self.assertEqual(len(data['actors']), 3, "Cast actors not returned")
+        self.assertLessEqual(queries.count, 2, "Movie actors not loaded in a fixed number of queries")
+        self.assertIsNone(res.headers.get("ETag"), "Cast list tagged with the movie version")
+
+    def test_cast_twice_then_uncast(self):
+        headers = {"Authorization": "Bearer {}".format(self.producer)}
+        res = self.client.post("/movie", headers=headers, json={"name": "Recast", "release_date": "2021-01-01"})
+        movie_id, etag = json.loads(res.data)['movie']['id'], res.headers["ETag"]
+        res = self.client.post("/actor", headers=headers, json={"name": "Recast Actor", "age": 30, "gender": "F"})
+        actor_id = json.loads(res.data)['actor']['id']
+        for _ in range(2):
+            res = self.client.post(f'/movie/{movie_id}/actors', headers=headers, json={"actor_id": actor_id})
+            self.assertEqual(res.status_code, 200, "Casting an actor twice failed")
+        res = self.client.get(f'/movie/{movie_id}/actors', headers=headers)
+        self.assertEqual([actor['id'] for actor in json.loads(res.data)['actors']], [actor_id])
+        res = self.client.patch(f'/movie/{movie_id}', headers=dict(headers, **{"If-Match": etag}), json={"name": "Recast 2"})
+        self.assertEqual(res.status_code, 412, "Movie version not bumped by the casting")
+        res = self.client.delete(f'/movie/{movie_id}/actors/{actor_id}', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        res = self.client.delete(f'/movie/{movie_id}/actors/{actor_id}', headers=headers)
+        self.assertEqual(res.status_code, 404, "Removing a missing casting succeeded")
+
+    def test_cast_unknown_actor(self):
+        headers = {"Authorization": "Bearer {}".format(self.producer)}
+        res = self.client.post("/movie", headers=headers, json={"name": "No Cast", "release_date": "2021-01-01"})
+        movie_id = json.loads(res.data)['movie']['id']
+        res = self.client.post(f'/movie/{movie_id}/actors', headers=headers, json={"actor_id": 999999})
+        self.assertEqual(res.status_code, 404, "Unknown actor cast")
+        res = self.client.get(f'/movie/{movie_id}/actors', headers=headers)
+        self.assertEqual(res.status_code, 200, "Session not rolled back after the failed casting")
+
+    def test_get_movies_include_actors_query_budget(self):
+        self.cast_new_movie(1)
+        with QueryCounter(db.engine) as small:
+            self.client.get("/movies?include=actors", headers={"Authorization": "Bearer {}".format(self.producer)})
+        for _ in range(3):
+            self.cast_new_movie(3)
+        with QueryCounter(db.engine) as large:
+            res = self.client.get("/movies?include=actors", headers={"Authorization": "Bearer {}".format(self.producer)})
+        self.assertTrue(all('actors' in movie for movie in json.loads(res.data)['movies']), "Actors not included")
+        self.assertEqual(large.count, small.count, "Query count grows with the number of movies (N+1)")
+
+# Every supported list filter must be able to use an index instead of a sequential scan
+class FilterIndexTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Tiny test tables always favour a Seq Scan, so only check that an index is usable
+        db.session.execute(db.text("SET LOCAL enable_seqscan = off"))
+
+    def explain(self, model, url, build_filters):
+        with self.app.test_request_context(url):
+            statement = db.select(model.id).where(*build_filters())
+        sql = statement.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True})
+        return "\n".join(row[0] for row in db.session.execute(db.text("EXPLAIN {}".format(sql))))
+
+    def assert_index_scan(self, model, url, build_filters):
+        plan = self.explain(model, url, build_filters)
+        self.assertNotIn("Seq Scan", plan, "{} uses a sequential scan".format(url))
+        self.assertIn("Index", plan, "{} uses no index".format(url))
+
+    def test_movie_filters_use_indexes(self):
+        for url in ["/movies?name=jab", "/movies?name_prefix=Pad", "/movies?release_date_from=2010-01-01",
+                    "/movies?release_date_from=2010-01-01&release_date_to=2015-12-31"]:
+            self.assert_index_scan(Movie, url, get_movie_filters)
+
+    def test_actor_filters_use_indexes(self):
+        for url in ["/actors?name=khan", "/actors?name_prefix=Kat", "/actors?min_age=30&max_age=40",
+                    "/actors?gender=F", "/actors?gender=M&min_age=50"]:
+            self.assert_index_scan(Actor, url, get_actor_filters)
+
+# Database Health Test Case
+class HealthTestCase(DatabaseTestCase):
+
+    def test_database_health_reports_pool(self):
+        res = self.client.get("/health/db")
+        data = json.loads(res.data)
+        self.assertTrue(data['success'], "Database health check failed")
+        for key in ("size", "checked_out", "idle", "wait_seconds_max"):
+            self.assertIn(key, data['pool'], "Pool status misses {}".format(key))
+
+# Checkout timeouts of the instrumented pool, on SQLite connections so no server is needed
+class PoolWaitStatsTestCase(unittest.TestCase):
+
+    def test_exhausted_pool_counts_a_timeout(self):
+        pool = InstrumentedQueuePool(lambda: sqlite3.connect(':memory:'), pool_size=1, max_overflow=0, timeout=0.01)
+        held = pool.connect()
+        with self.assertRaises(sqlalchemy_exc.TimeoutError):
+            pool.connect()
+        held.close()
+        self.assertEqual(pool.wait_stats.as_dict()['timeouts'], 1)
+
+    def test_failed_connect_is_not_a_timeout(self):
+        def refuse():
+            raise sqlite3.OperationalError("connection refused")
+        pool = InstrumentedQueuePool(refuse, pool_size=1, max_overflow=0, timeout=0.01)
+        with self.assertRaises(sqlite3.OperationalError):
+            pool.connect()
+        self.assertEqual(pool.wait_stats.as_dict()['timeouts'], 0, "Failed connect counted as a timeout")
+
+# A failing EXPLAIN of a slow query must leave the transaction of the request usable
+class SlowQueryExplainTestCase(DatabaseTestCase):
+
+    def test_failed_explain_keeps_the_transaction(self):
+        connection = db.session.connection()
+        cursor = connection.connection.driver_connection.cursor()
+        plan = QueryProfiler.explain(connection, cursor, "SELECT * FROM no_such_table", None, False)
+        self.assertIsNone(plan)
+        self.assertIsNotNone(QueryProfiler.explain(connection, cursor, "SELECT 1", None, False))
+        self.assertEqual(db.session.execute(db.text("SELECT 1")).scalar(), 1)
+
+# JWKS Cache Test Cases, served from a local file so they run offline
+class JWKSCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.jwks_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        json.dump({"keys": [{"kid": "test-kid", "kty": "RSA", "use": "sig", "n": "AQAB", "e": "AQAB"}]}, self.jwks_file)
+        self.jwks_file.close()
+        self.cache = JWKSCache(self.jwks_file.name, ttl=3600, min_refresh_interval=60, background_refresh=False)
+
+    def tearDown(self):
+        os.remove(self.jwks_file.name)
+
+    def test_keys_fetched_once(self):
+        for _ in range(10):
+            self.assertIsNotNone(self.cache.get_key("test-kid"), "Known kid not found in JWKS")
+        self.assertEqual(self.cache.fetch_count, 1, "JWKS fetched more than once within TTL")
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        self.cache.get_key("test-kid")
+        for _ in range(10):
+            self.assertIsNone(self.cache.get_key("unknown-kid"), "Unknown kid returned a key")
+        self.assertEqual(self.cache.fetch_count, 1, "Unknown kid caused a fetch inside the refresh interval")
+
+    def test_unknown_kid_refetches_after_interval(self):
+        self.cache.min_refresh_interval = 0
+        self.cache.get_key("test-kid")
+        self.cache.get_key("unknown-kid")
+        self.assertEqual(self.cache.fetch_count, 2, "Unknown kid did not trigger a refetch")
+
+    def test_expired_key_set_is_refetched(self):
+        self.cache.ttl = 0
+        self.cache.get_key("test-kid")
+        self.cache.get_key("test-kid")
+        self.assertEqual(self.cache.fetch_count, 2, "Expired JWKS was not refetched")
+
+    def test_keys_are_prebuilt_per_allowed_algorithm(self):
+        keys = JWKSCache.build_keys({"keys": [
+            {"kid": "rs", "kty": "RSA", "use": "sig", "n": "AQAB", "e": "AQAB"},
+            {"kid": "hs", "kty": "oct", "k": "c2VjcmV0"},
+            {"kid": "rs512", "kty": "RSA", "alg": "RS512", "n": "AQAB", "e": "AQAB"}]})
+        self.assertEqual(list(keys), ["rs"], "Non RSA or disallowed algorithm key was kept")
+        self.assertEqual(list(keys["rs"]), ["RS256"], "Verifier not built for the allowed algorithm")
+
+    def test_algorithms_whitelist(self):
+        self.assertEqual(parse_algorithms("['RS256']"), ["RS256"])
+        self.assertEqual(parse_algorithms("RS256,HS256"), ["RS256"], "HS256 was allowed")
+        self.assertRaises(ValueError, parse_algorithms, "none")
+
+# Verified Token Cache Test Cases
+class VerifiedTokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = VerifiedTokenCache(maxsize=2)
+        self.payload = {"sub": "tester", "exp": time.time() + 60, "permissions": ["view:movies"]}
+
+    def test_cached_payload_is_returned(self):
+        self.assertIsNone(self.cache.get("token-a"), "Empty cache returned a payload")
+        self.cache.set("token-a", self.payload)
+        self.assertEqual(self.cache.get("token-a"), self.payload, "Cached payload not returned")
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1), "Hits and misses not counted")
+
+    def test_entry_expires_at_exp_claim(self):
+        self.cache.set("token-a", dict(self.payload, exp=time.time() - 1))
+        self.assertIsNone(self.cache.get("token-a"), "Expired token returned from cache")
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.cache.set("token-a", self.payload)
+        self.cache.set("token-b", self.payload)
+        self.cache.get("token-a")
+        self.cache.set("token-c", self.payload)
+        self.assertIsNone(self.cache.get("token-b"), "Least recently used token was not evicted")
+        self.assertIsNotNone(self.cache.get("token-a"), "Recently used token was evicted")
+
+# Local Token Issuer Test Cases, verified through the in-process key source
+class LocalTokenIssuerTestCase(unittest.TestCase):
+
+    def test_role_token_is_verified(self):
+        payload = verify_decode_jwt(token_issuer.mint_role('casting_director'))
+        self.assertEqual(payload['sub'], 'local|casting_director')
+        self.assertIn('update:movie', payload['permissions'])
+        self.assertNotIn('delete:movie', payload['permissions'])
+
+    def test_expired_token_is_rejected(self):
+        with self.assertRaises(AuthError) as context:
+            verify_decode_jwt(token_issuer.mint_role('casting_assistant', expires_in=-60))
+        self.assertEqual(context.exception.error['code'], 'token_expired')
+
+    def test_token_of_another_key_is_rejected(self):
+        other_issuer = LocalTokenIssuer(AUTH0_DOMAIN, API_AUDIENCE, key_size=1024)
+        with self.assertRaises(AuthError) as context:
+            verify_decode_jwt(other_issuer.mint_role('executive_producer'))
+        self.assertEqual(context.exception.status_code, 400)
+
+# Permission Check Test Cases
+class PermissionsTestCase(unittest.TestCase):
+
+    def test_all_of_and_any_of(self):
+        granted = token_permissions({"permissions": ["view:movies", "post:movie"]})
+        self.assertTrue(RequiredPermissions(["view:movies", "post:movie"]).allows(granted))
+        self.assertFalse(RequiredPermissions(["view:movies", "delete:movie"]).allows(granted), "all-of passed with one missing")
+        self.assertTrue(RequiredPermissions(any_of=["delete:movie", "post:movie"]).allows(granted))
+        self.assertFalse(RequiredPermissions(any_of=["delete:movie", "delete:actor"]).allows(granted), "any-of passed with none granted")
+
+    def test_missing_permissions_claim_is_auth_error(self):
+        with self.assertRaises(AuthError) as context:
+            check_permissions('view:movies', token_permissions({"sub": "tester"}))
+        self.assertEqual(context.exception.status_code, 403)
+        with self.assertRaises(AuthError) as context:
+            check_permissions('delete:movie', frozenset(['view:movies']))
+        self.assertEqual(context.exception.error['code'], 'unauthorized')
+
+    def test_route_permissions_registry(self):
+        app = Flask(__name__)
+
+        @app.route('/movies')
+        @requires_auth('view:movies')
+        def movies(payload):
+            return jsonify([])
+
+        @app.route('/cast', methods=['POST'])
+        @requires_auth(any_of=['post:actor', 'update:movie'])
+        def cast(payload):
+            return jsonify([])
+
+        routes = {rule: (methods, required) for rule, methods, endpoint, required in route_permissions(app)}
+        self.assertEqual(routes['/movies'][1].all_of, frozenset(['view:movies']))
+        self.assertEqual(routes['/cast'][0], ['POST'])
+        self.assertEqual(routes['/cast'][1].any_of, frozenset(['post:actor', 'update:movie']))
+        self.assertIsNone(routes['/static/<path:filename>'][1], "Public route listed with permissions")
+
+# Response Cache Test Cases
+class ResponseCacheTestCase(unittest.TestCase):
+
+    def test_bump_changes_etag(self):
+        cache = ResponseCache()
+        etag = cache.etag("movies", "/movies?")
+        cache.set(etag, b"{}")
+        cache.bump("movies")
+        self.assertNotEqual(cache.etag("movies", "/movies?"), etag, "ETag unchanged after a write")
+        self.assertIsNone(cache.get(cache.etag("movies", "/movies?")), "Stale body served after a write")
+
+    def test_etags_without_shared_backend_are_per_process(self):
+        worker_a, worker_b = ResponseCache(), ResponseCache()
+        self.assertNotEqual(worker_a.etag("movies", "/movies?"), worker_b.etag("movies", "/movies?"),
+                            "Same ETag from two processes with their own versions")
+
+    def test_local_body_expires(self):
+        cache = ResponseCache(LocalCacheBackend(ttl=0.05))
+        etag = cache.etag("movies", "/movies?")
+        cache.set(etag, b"{}")
+        self.assertTrue(cache.revalidates(etag), "Cached body not revalidated")
+        time.sleep(0.06)
+        self.assertIsNone(cache.get(etag), "Body served after its TTL")
+        self.assertFalse(cache.revalidates(etag), "304 answered for an expired body without a shared backend")
+
+    def test_shared_backend_invalidates_other_workers(self):
+        shared = DictSharedBackend()
+        worker_a, worker_b = ResponseCache(shared=shared), ResponseCache(shared=shared)
+        etag = worker_b.etag("actors", "/actors?")
+        worker_a.bump("actors")
+        self.assertNotEqual(worker_b.etag("actors", "/actors?"), etag, "Write on one worker not seen by another")
+
+# Metrics Test Cases, on a bare Flask app so they run offline
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = RequestMetrics()
+        self.app = Flask(__name__)
+        setup_metrics(self.app, server_timing=True, metrics=self.metrics)
+
+        @self.app.route('/item/<int:id>')
+        def item(id):
+            return jsonify({"success": True, "id": id})
+
+        self.client = self.app.test_client()
+
+    def test_requests_recorded_per_route_and_status(self):
+        self.client.get('/item/1')
+        self.client.get('/item/2')
+        self.client.get('/missing')
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('http_request_duration_seconds_count{route="/item/<int:id>",method="GET",status="200"} 2', text)
+        self.assertIn('http_request_duration_seconds_count{route="unmatched",method="GET",status="404"} 1', text)
+        self.assertIn('phase="json",le="+Inf"} 2', text)
+
+    def test_server_timing_header(self):
+        res = self.client.get('/item/1')
+        self.assertIn('json;dur=', res.headers['Server-Timing'])
+        self.assertIn('total;dur=', res.headers['Server-Timing'])
+
+# Query Profiler Test Cases, on SQLite so they run offline
+class QueryProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        self.db_file.close()
+        self.app = Flask(__name__)
+        setup_db(self.app, 'sqlite:///' + self.db_file.name)
+        self.app.config["QUERY_COUNT_HEADER"] = True
+
+        @self.app.route('/two-queries')
+        def two_queries():
+            db.session.execute(db.text("SELECT 1"))
+            db.session.execute(db.text("SELECT 2"))
+            return jsonify({"success": True})
+
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        os.remove(self.db_file.name)
+
+    def test_query_count_header_is_per_request(self):
+        for _ in range(2):
+            res = self.client.get('/two-queries')
+            self.assertEqual(res.headers["X-Query-Count"], "2", "Queries of the request not counted")
+
+# Fast Serialization Test Cases, the fast path must return the bytes jsonify() returns
+class SerializationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.rows = [{"id": 1, "name": "Dear Zindagi", "release_date": datetime(2016, 11, 25).date(), "actors": []},
+                     {"id": 2, "name": "Amélie \"Poulain\"", "release_date": None, "actors": [{"id": 3, "age": 40}]}]
+
+    def expected(self):
+        rows = [dict(row, release_date=row["release_date"].isoformat() if row["release_date"] else None) for row in self.rows]
+        return jsonify({"success": True, "movies": rows}).get_data()
+
+    def test_same_bytes_as_jsonify(self):
+        with self.app.app_context():
+            self.assertEqual(json_response({"success": True, "movies": self.rows}).get_data(), self.expected())
+
+    def test_same_bytes_as_jsonify_in_debug(self):
+        self.app.debug = True
+        with self.app.app_context():
+            self.assertEqual(json_response({"success": True, "movies": self.rows}).get_data(), self.expected())
+
+# Read replica database of the tests, next to the test database
+REPLICA_DATABASE_URI = TEST_DATABASE_URI + '_replica'
+
+'''
+ReadReplicaTestCase
+Read routing of the real routes, on the test database and a second Postgres database as its replica
+    the replica is not fed by the primary, it holds a row of its own, so a read shows where it was served
+    two replica binds point at it, so both strategies have two replicas to choose from
+    the app commits for real here, both databases are emptied in tearDown
+'''
+class ReadReplicaTestCase(unittest.TestCase):
+    app = None
+
+    @classmethod
+    def setUpClass(cls):
+        if not database_exists(REPLICA_DATABASE_URI):
+            create_database(REPLICA_DATABASE_URI, template='template0')
+        cls.app = create_app(TEST_DATABASE_URI, [REPLICA_DATABASE_URI, REPLICA_DATABASE_URI])
+        audit_log.configure(None)
+        with cls.app.app_context():
+            db.create_all()
+            db.metadata.create_all(db.engines['replica_0'])
+
+    @classmethod
+    def tearDownClass(cls):
+        with cls.app.app_context():
+            for engine in db.engines.values():
+                engine.dispose()
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            with db.engines['replica_0'].begin() as connection:
+                connection.execute(Movie.__table__.insert(), {"name": "Replica Only", "release_date": datetime(2000, 1, 1).date()})
+
+    def tearDown(self):
+        with self.app.app_context():
+            for engine in (db.engine, db.engines['replica_0']):
+                with engine.begin() as connection:
+                    connection.execute(db.text('TRUNCATE casting, movies, actors RESTART IDENTITY CASCADE'))
+        for collection in ('movies', 'actors'):
+            response_cache.bump(collection)
+
+    def get_movie_names(self, token, path='/movies'):
+        res = self.client.get(path, headers={"Authorization": "Bearer {}".format(token)})
+        return res, [movie['name'] for movie in res.get_json()['movies']]
+
+    def post_movie(self, token):
+        return self.client.post('/movie', headers={"Authorization": "Bearer {}".format(token)},
+                                json={"name": "Primary Write", "release_date": "2020-01-01"})
+
+    def test_reads_go_to_replica_and_writes_to_primary(self):
+        self.assertEqual(self.get_movie_names(CASTING_ASSISTANT_TOKEN)[1], ["Replica Only"], "GET not served by the replica")
+        self.assertEqual(self.post_movie(EXECUTIVE_PRODUCER_TOKEN).status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(db.session.execute(db.select(Movie.name)).scalars().all(), ["Primary Write"], "Write not sent to the primary")
+
+    def test_writer_reads_its_writes_from_primary(self):
+        self.post_movie(EXECUTIVE_PRODUCER_TOKEN)
+        res, names = self.get_movie_names(EXECUTIVE_PRODUCER_TOKEN)
+        self.assertEqual(names, ["Primary Write"], "Writer read from the lagging replica")
+        self.assertIsNotNone(res.headers.get("ETag"), "Primary read not tagged")
+        # Another URL, the body the writer just got is cached for the current version
+        res, names = self.get_movie_names(CASTING_ASSISTANT_TOKEN, '/movies?limit=10')
+        self.assertEqual(names, ["Replica Only"], "Other client not served by the replica")
+        self.assertIsNone(res.headers.get("ETag"), "Replica read right after a write was tagged")
+
+    def test_health_probes_each_replica_on_its_own_pool(self):
+        before = self.client.get("/health/db").get_json()['replicas']
+        res = self.client.get("/health/db")
+        replicas = res.get_json()['replicas']
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(replicas), ['replica_0', 'replica_1'])
+        for key, replica in replicas.items():
+            self.assertTrue(replica['success'], "Health check of {} failed".format(key))
+            # The probe ran on the replica's own engine, through its own pool
+            self.assertEqual(replica['pool']['checkouts'], before[key]['pool']['checkouts'] + 1,
+                             "{} was not probed on its pool".format(key))
+
+    def test_least_connections(self):
+        router = ReplicaRouter(['replica_0', 'replica_1'], 'least_connections')
+        with self.app.app_context():
+            engines = db.engines
+            with engines['replica_0'].connect():
+                self.assertEqual(router.choose(engines), 'replica_1', "Busy replica chosen")
+            with engines['replica_1'].connect():
+                self.assertEqual(router.choose(engines), 'replica_0', "Busy replica chosen")
+
+    def test_several_workers_need_a_shared_backend(self):
+        with self.assertRaises(RuntimeError):
+            setup_read_replicas(Flask(__name__), ['replica_0'], workers=2)
+
+    def test_round_robin(self):
+        router = ReplicaRouter(['replica_0', 'replica_1'], 'round_robin')
+        self.assertEqual([router.choose({}) for _ in range(4)], ['replica_0', 'replica_1', 'replica_0', 'replica_1'])
+
+# Idempotency Key Test Cases, concurrent requests on a bare Flask app
+class IdempotencyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.inserts = []
+
+        @self.app.route('/slow-insert', methods=['POST'])
+        @idempotent
+        def slow_insert():
+            time.sleep(0.2)
+            self.inserts.append(request.get_json())
+            return jsonify({"id": len(self.inserts)})
+
+        self.client = self.app.test_client()
+
+    def test_concurrent_requests_insert_once(self):
+        responses = []
+
+        def post():
+            responses.append(self.client.post('/slow-insert', headers={"Idempotency-Key": "concurrent"}, json={"n": 1}))
+
+        threads = [threading.Thread(target=post) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.inserts), 1, "Concurrent requests with one key inserted twice")
+        self.assertEqual([res.get_json() for res in responses], [{"id": 1}, {"id": 1}])
+        self.assertEqual(sorted(res.headers.get("Idempotent-Replayed", "") for res in responses), ["", "true"])
+
+    def test_local_store_is_bounded(self):
+        store = LocalCacheBackend(maxsize=2)
+        for key in ("a", "b", "c"):
+            self.assertTrue(store.add(key, "pending", ttl=60))
+        self.assertFalse(store.add("c", "pending", ttl=60), "Claimed key claimed twice")
+        self.assertIsNone(store.get("a"), "Least recently used key kept past maxsize")
+
+    def key_for(self, token, sub):
+        with self.app.test_request_context('/slow-insert', headers={"Authorization": "Bearer " + token}):
+            g.jwt_payload = {"sub": sub}
+            return IdempotencyStore(DictSharedBackend()).key("k")
+
+    def test_key_is_scoped_to_the_client(self):
+        self.assertNotEqual(self.key_for("a", "client-a"), self.key_for("b", "client-b"), "Two clients share an idempotency key")
+
+    def test_key_survives_a_token_refresh(self):
+        self.assertEqual(self.key_for("old", "client-a"), self.key_for("refreshed", "client-a"),
+                         "A retry with a refreshed token gets a new idempotency key")
+
+# Audit Log Test Cases, written to a local file or to fake sinks so they run offline
+class AuditLogTestCase(unittest.TestCase):
+
+    class FlakySink:
+        def __init__(self, failures):
+            self.failures = failures
+            self.events = []
+
+        def write(self, events):
+            if self.failures:
+                self.failures -= 1
+                raise IOError("sink unavailable")
+            self.events.extend(events)
+
+    def test_events_written_to_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'audit.log')
+            log = AuditLog(FileAuditSink(path), flush_interval=0.01)
+            log.record('create', 'movies', 1, {"id": 1, "release_date": datetime(2020, 1, 2).date()})
+            log.record('delete', 'movies', 1)
+            self.assertTrue(log.flush(), "Audit events not flushed")
+            log.close()
+            with open(path) as file:
+                events = [json.loads(line) for line in file]
+        self.assertEqual([event['action'] for event in events], ['create', 'delete'])
+        self.assertEqual(events[0]['data']['release_date'], '2020-01-02')
+
+    def test_failed_batch_is_retried(self):
+        sink = self.FlakySink(failures=1)
+        log = AuditLog(sink, flush_interval=0.01)
+        log.record('update', 'actors', 7, {"age": 40})
+        self.assertTrue(log.flush(), "Audit events not flushed")
+        log.close()
+        self.assertEqual([event['row_id'] for event in sink.events], [7])
+
+    def test_failing_batch_dropped_after_max_attempts(self):
+        sink = self.FlakySink(failures=1000)
+        log = AuditLog(sink, flush_interval=0.01, max_attempts=3)
+        log.record_many('delete', 'actors', [(1, None), (2, None)])
+        self.assertTrue(log.flush(), "Failing batch retried forever")
+        sink.failures = 0
+        log.record('update', 'actors', 3, {"age": 40})
+        self.assertTrue(log.flush(), "Audit events not flushed")
+        log.close()
+        stats = log.stats()
+        self.assertEqual((stats['dropped'], stats['failed_batches'], stats['written']), (2, 3, 1))
+        self.assertEqual([event['row_id'] for event in sink.events], [3])
+
+    def test_full_queue_drops_after_timeout(self):
+        sink = self.FlakySink(failures=1000)
+        log = AuditLog(sink, maxsize=2, batch_size=1, flush_interval=0.05, block_timeout=0.01)
+        for id in range(10):
+            log.record('create', 'actors', id, {"id": id})
+        self.assertGreater(log.stats()['dropped'], 0, "Events not dropped when the queue is full")
+        sink.failures = 0
+        log.close()
+
 if __name__ == "__main__":
     unittest.main()